@@ -1,8 +1,9 @@
 import asyncio
+import contextlib
+import functools
 import sys
 from typing import TYPE_CHECKING
 
-import aiojobs
 import orjson
 import tenacity
 from aiogram import Bot, Dispatcher
@@ -11,6 +12,7 @@ from aiogram.client.telegram import TelegramAPIServer
 from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
 from aiohttp import web
 from redis.asyncio import Redis
+from redis.exceptions import RedisError
 
 from aiogram_bot_template import handlers, utils, web_handlers
 from aiogram_bot_template.data import config
@@ -112,25 +114,95 @@ async def setup_aiogram(dp: Dispatcher) -> None:
     logger.info("Configured aiogram")
 
 
+def handoff_key() -> str:
+    return f"tg_updates:handoff:{config.BOT_ID}"
+
+
+def handoff_redis(dp: Dispatcher) -> Redis | None:
+    if isinstance(dp.storage, RedisStorage):
+        return dp.storage.redis
+    return None
+
+
+async def replay_handed_off(
+    dp: Dispatcher,
+    redis: Redis,
+    update_pool: utils.update_pool.UpdatePool,
+) -> None:
+    raw_updates, stale = await utils.update_pool.take_handed_off(
+        redis,
+        handoff_key(),
+        config.HANDOFF_MAX_AGE,
+        dp["aiogram_logger"],
+    )
+    for raw_update in raw_updates:
+        update_pool.submit(raw_update)
+    if raw_updates:
+        dp["aiogram_logger"].info(
+            "Replaying handed-off updates",
+            count=len(raw_updates),
+        )
+    if stale:
+        dp["aiogram_logger"].warning("Dropped stale handed-off updates", count=stale)
+
+
+async def claim_handed_off(app: web.Application, stop: asyncio.Event) -> None:
+    # In a rolling deploy the replacement starts before the old process
+    # drains, so a hand-off can appear at any time: every running replica
+    # polls for it until shutdown begins.
+    dp: Dispatcher = app["dp"]
+    redis = handoff_redis(dp)
+    if redis is None:
+        return
+    while not stop.is_set():
+        try:
+            await replay_handed_off(dp, redis, app["update_pool"])
+        except (RedisError, ValueError):
+            dp["aiogram_logger"].exception("Failed to claim handed-off updates")
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(stop.wait(), config.HANDOFF_POLL_INTERVAL)
+
+
 async def aiohttp_on_startup(app: web.Application) -> None:
     dp: Dispatcher = app["dp"]
+    update_pool: utils.update_pool.UpdatePool = app["update_pool"]
+    update_pool.start()
     workflow_data = {"app": app, "dispatcher": dp}
     if "bot" in app:
         workflow_data["bot"] = app["bot"]
     await dp.emit_startup(**workflow_data)
 
+    app["handoff_stop"] = asyncio.Event()
+    app["handoff_task"] = asyncio.create_task(
+        claim_handed_off(app, app["handoff_stop"]),
+    )
+
 
 async def aiohttp_on_shutdown(app: web.Application) -> None:
     dp: Dispatcher = app["dp"]
-    for i in [app, *app._subapps]:  # noqa: SLF001 # dirty
-        if "scheduler" in i:
-            scheduler: aiojobs.Scheduler = i["scheduler"]
-            scheduler._closed = True  # noqa: SLF001
-            while scheduler.pending_count != 0:
-                dp["aiogram_logger"].info(
-                    f"Waiting for {scheduler.pending_count} tasks to complete",
-                )
-                await asyncio.sleep(1)
+    update_pool: utils.update_pool.UpdatePool = app["update_pool"]
+    # Let the claim loop finish its current round rather than cancelling it
+    # between LRANGE+DEL and submit, which would lose the claimed updates.
+    app["handoff_stop"].set()
+    await app["handoff_task"]
+    dp["aiogram_logger"].info(
+        "Draining updates",
+        pending=update_pool.pending_count,
+        timeout=config.SHUTDOWN_DRAIN_TIMEOUT,
+    )
+    leftover = await update_pool.drain(config.SHUTDOWN_DRAIN_TIMEOUT)
+    if leftover:
+        redis = handoff_redis(dp)
+        if redis is None:
+            dp["aiogram_logger"].warning("Dropping queued updates", count=len(leftover))
+        else:
+            await utils.update_pool.hand_off(
+                redis,
+                handoff_key(),
+                leftover,
+                config.HANDOFF_MAX_AGE,
+            )
+            dp["aiogram_logger"].info("Handed off queued updates", count=len(leftover))
     workflow_data = {"app": app, "dispatcher": dp}
     if "bot" in app:
         workflow_data["bot"] = app["bot"]
@@ -181,7 +253,25 @@ async def setup_aiohttp_app(  # noqa: RUF029
     bot: Bot,
     dp: Dispatcher,
 ) -> web.Application:
-    scheduler = aiojobs.Scheduler()
+    update_pool = utils.update_pool.UpdatePool(
+        functools.partial(
+            web_handlers.tg_updates.process_update,
+            bot=bot,
+            dp=dp,
+            workflow_data={"dp": dp},
+        ),
+        workers=config.WEBHOOK_WORKERS,
+        logger=utils.logging.setup_logger().bind(type="update_pool"),
+        admission=utils.admission.AdmissionController(
+            initial=config.MAX_UPDATES_IN_QUEUE,
+            ceiling=config.MAX_UPDATES_IN_QUEUE_CEILING,
+            floor=2 * config.WEBHOOK_WORKERS,
+            workers=config.WEBHOOK_WORKERS,
+            target=config.ADMISSION_TARGET_DELAY,
+            interval=config.ADMISSION_INTERVAL,
+            logger=utils.logging.setup_logger().bind(type="admission"),
+        ),
+    )
     app = web.Application()
     subapps: list[tuple[str, web.Application]] = [
         ("/tg/webhooks/", web_handlers.tg_updates_app),
@@ -189,11 +279,11 @@ async def setup_aiohttp_app(  # noqa: RUF029
     for prefix, subapp in subapps:
         subapp["bot"] = bot
         subapp["dp"] = dp
-        subapp["scheduler"] = scheduler
+        subapp["update_pool"] = update_pool
         app.add_subapp(prefix, subapp)
     app["bot"] = bot
     app["dp"] = dp
-    app["scheduler"] = scheduler
+    app["update_pool"] = update_pool
     app.on_startup.append(aiohttp_on_startup)  # type: ignore[arg-type]
     app.on_shutdown.append(aiohttp_on_shutdown)  # type: ignore[arg-type]
     return app
@@ -67,7 +67,20 @@ if USE_WEBHOOK:
     MAIN_WEBHOOK_LISTENING_HOST: str = env.str("MAIN_WEBHOOK_LISTENING_HOST")
     MAIN_WEBHOOK_LISTENING_PORT: int = env.int("MAIN_WEBHOOK_LISTENING_PORT")
 
+    # Initial admission limit and the hard maximum it may grow to; the actual
+    # limit adapts to the measured queue wait (see utils.admission).
     MAX_UPDATES_IN_QUEUE: int = env.int("MAX_UPDATES_IN_QUEUE", 100)
+    MAX_UPDATES_IN_QUEUE_CEILING: int = env.int("MAX_UPDATES_IN_QUEUE_CEILING", 1000)
+    WEBHOOK_WORKERS: int = env.int("WEBHOOK_WORKERS", 16)
+    ADMISSION_TARGET_DELAY: float = env.float("ADMISSION_TARGET_DELAY", 0.2)
+    ADMISSION_INTERVAL: float = env.float("ADMISSION_INTERVAL", 2.0)
+    # Seconds to finish queued updates on shutdown; the rest is handed off
+    # through Redis to the next process.
+    SHUTDOWN_DRAIN_TIMEOUT: float = env.float("SHUTDOWN_DRAIN_TIMEOUT", 20.0)
+    # Handed-off updates older than this are dropped, not replayed; running
+    # replicas check for a hand-off every HANDOFF_POLL_INTERVAL seconds.
+    HANDOFF_MAX_AGE: float = env.float("HANDOFF_MAX_AGE", 120.0)
+    HANDOFF_POLL_INTERVAL: float = env.float("HANDOFF_POLL_INTERVAL", 5.0)
 
 USE_CUSTOM_API_SERVER: bool = env.bool("USE_CUSTOM_API_SERVER", False)
 
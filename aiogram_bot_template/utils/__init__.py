@@ -1,4 +1,6 @@
+from . import admission as admission
 from . import chunks as chunks
 from . import connect_to_services as connect_to_services
 from . import logging as logging
 from . import smart_session as smart_session
+from . import update_pool as update_pool
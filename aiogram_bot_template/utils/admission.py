@@ -0,0 +1,103 @@
+import time
+
+import structlog
+
+DECREASE_FACTOR = 0.7
+
+
+# CoDel-style admission for the update pool. A burst that drains quickly is
+# fine; a standing queue is not. So the signal is the *minimum* queue wait
+# seen during an interval: if even the luckiest update waited longer than
+# target, the limit on accepted updates is cut (multiplicatively, and never
+# above what the workers can clear within target at the measured handler
+# latency); otherwise it grows, additively or straight to that capacity
+# when it is higher, up to the ceiling. The limit starts at initial and may
+# end up on either side of it.
+class AdmissionController:
+    def __init__(  # noqa: PLR0913
+        self,
+        *,
+        initial: int,
+        ceiling: int,
+        floor: int,
+        workers: int,
+        target: float,
+        interval: float,
+        logger: structlog.typing.FilteringBoundLogger,
+    ) -> None:
+        self.ceiling = ceiling
+        self.floor = min(floor, ceiling)
+        self.workers = workers
+        self.target = target
+        self.interval = interval
+        self._logger = logger
+        self._limit = max(self.floor, min(initial, ceiling))
+        self._step = max(1, self._limit // 10)
+        self._interval_start = time.monotonic()
+        self._min_wait: float | None = None
+        self._latency: float | None = None
+        self._shed_interval = 0
+        self.shed_total = 0
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def latency(self) -> float | None:
+        # Moving average of handler latency, seconds.
+        return self._latency
+
+    def admit(self, pending: int) -> bool:
+        if pending < self._limit:
+            return True
+        self._shed_interval += 1
+        self.shed_total += 1
+        return False
+
+    def observe(self, wait: float, latency: float) -> None:
+        if self._min_wait is None or wait < self._min_wait:
+            self._min_wait = wait
+        self._latency = (
+            latency if self._latency is None else 0.9 * self._latency + 0.1 * latency
+        )
+
+        now = time.monotonic()
+        if now - self._interval_start < self.interval:
+            return
+        self._adjust(self._min_wait)
+        self._interval_start = now
+        self._min_wait = None
+        self._shed_interval = 0
+
+    def _capacity(self) -> int | None:
+        # Little's law: workers * (1 + target / latency) updates in the
+        # system keep the queue wait around target.
+        if not self._latency:
+            return None
+        return int(self.workers * (1 + self.target / self._latency))
+
+    def _adjust(self, min_wait: float) -> None:
+        previous = self._limit
+        capacity = self._capacity()
+        if min_wait > self.target:
+            decreased = int(self._limit * DECREASE_FACTOR)
+            if capacity is not None:
+                decreased = min(decreased, capacity)
+            self._limit = max(self.floor, decreased)
+        else:
+            increased = self._limit + self._step
+            if capacity is not None:
+                increased = max(increased, capacity)
+            self._limit = min(self.ceiling, increased)
+
+        if self._limit != previous or self._shed_interval:
+            self._logger.info(
+                "Admission limit updated",
+                limit=self._limit,
+                previous_limit=previous,
+                min_queue_wait_ms=round(min_wait * 1000, 1),
+                handler_latency_ms=round((self._latency or 0) * 1000, 1),
+                shed=self._shed_interval,
+                shed_total=self.shed_total,
+            )
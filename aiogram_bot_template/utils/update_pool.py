@@ -0,0 +1,200 @@
+import asyncio
+import collections
+import collections.abc
+import contextlib
+import math
+import re
+import time
+
+import redis.asyncio as redis
+import structlog
+
+from .admission import AdmissionController
+
+UpdateHandler = collections.abc.Callable[[bytes], collections.abc.Awaitable[None]]
+
+
+# Updates of one chat (or one user, for chatless updates like inline queries)
+# share a key and are processed in order; updates with neither get a unique
+# key and are not ordered against anything. This runs in the webhook handler
+# for every update, so instead of parsing the body it scans for the first
+# "chat" object and falls back to "from"/"user". A key inside a string value
+# would have its quotes escaped, so only real keys match; "forward_from_chat"
+# and the like do not, since the opening quote is part of the pattern.
+_CHAT_ID = re.compile(rb'"chat"\s*:\s*\{\s*"id"\s*:\s*(-?\d+)')
+_SENDER_ID = re.compile(rb'"(?:from|user)"\s*:\s*\{\s*"id"\s*:\s*(-?\d+)')
+
+
+def shard_key(raw_update: bytes) -> int | str:
+    for pattern in (_CHAT_ID, _SENDER_ID):
+        match = pattern.search(raw_update)
+        if match is not None:
+            return int(match.group(1))
+    return f"unordered:{id(raw_update)}"
+
+
+# Fixed number of workers over per-key FIFO queues. A key is served by at
+# most one worker at a time and goes to the back of the ready queue after
+# each update, so a busy chat never holds up the others.
+class UpdatePool:
+    def __init__(
+        self,
+        handler: UpdateHandler,
+        *,
+        workers: int,
+        logger: structlog.typing.FilteringBoundLogger,
+        admission: AdmissionController | None = None,
+    ) -> None:
+        self._handler = handler
+        self._workers_count = workers
+        self._logger = logger
+        self.admission = admission
+        # Per key: (monotonic time of submit, raw update).
+        self._queues: dict[int | str, collections.deque[tuple[float, bytes]]] = {}
+        self._ready: asyncio.Queue[int | str] = asyncio.Queue()
+        self._workers: list[asyncio.Task[None]] = []
+        self._pending = 0
+        self._closed = False
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def pending_count(self) -> int:
+        # Accepted and not finished yet, running ones included.
+        return self._pending
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def admit(self) -> bool:
+        if self.admission is None:
+            return True
+        return self.admission.admit(self._pending)
+
+    def start(self) -> None:
+        for i in range(self._workers_count):
+            self._workers.append(
+                asyncio.create_task(self._worker(), name=f"update-worker-{i}"),
+            )
+
+    def submit(self, raw_update: bytes) -> None:
+        if self._closed:
+            msg = "Update pool is closed"
+            raise RuntimeError(msg)
+        key = shard_key(raw_update)
+        self._pending += 1
+        self._idle.clear()
+        item = (time.monotonic(), raw_update)
+        queue = self._queues.get(key)
+        if queue is not None:
+            # The key is already queued or being served; its worker gets here.
+            queue.append(item)
+            return
+        self._queues[key] = collections.deque((item,))
+        self._ready.put_nowait(key)
+
+    def close(self) -> None:
+        # Stops accepting; already queued updates are still processed.
+        self._closed = True
+
+    async def drain(self, timeout: float) -> list[bytes]:
+        # Stops accepting and waits for the queue to empty, at most timeout
+        # seconds. Updates that have not started by then are returned (in
+        # per-chat order) for hand-off; ones still running are cancelled.
+        self.close()
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        leftover = [raw for queue in self._queues.values() for _, raw in queue]
+        if self._pending:
+            self._logger.warning(
+                "Drain deadline reached",
+                queued=len(leftover),
+                running=self._pending - len(leftover),
+            )
+        for queue in self._queues.values():
+            queue.clear()
+        await self.stop()
+        return leftover
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    async def _worker(self) -> None:
+        while True:
+            key = await self._ready.get()
+            queue = self._queues[key]
+            submitted_at, raw_update = queue.popleft()
+            started_at = time.monotonic()
+            try:
+                await self._handler(raw_update)
+            except Exception:
+                self._logger.exception("Update handler failed", shard=str(key))
+            finally:
+                self._pending -= 1
+                if not self._pending:
+                    self._idle.set()
+                if self.admission is not None:
+                    self.admission.observe(
+                        wait=started_at - submitted_at,
+                        latency=time.monotonic() - started_at,
+                    )
+                if queue:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._queues[key]
+
+
+# Hand-off entries are "<unix time>\n<raw update>": whoever claims the list
+# drops entries older than max_age instead of replaying stale input.
+async def hand_off(
+    connection: redis.Redis,
+    key: str,
+    raw_updates: list[bytes],
+    max_age: float,
+) -> None:
+    if not raw_updates:
+        return
+    stamp = f"{time.time():.3f}\n".encode()
+    async with connection.pipeline(transaction=True) as pipe:
+        pipe.rpush(key, *(stamp + raw_update for raw_update in raw_updates))
+        # Nobody claimed the list in time: every entry in it is stale anyway.
+        pipe.expire(key, math.ceil(max_age))
+        await pipe.execute()
+
+
+async def take_handed_off(
+    connection: redis.Redis,
+    key: str,
+    max_age: float,
+    logger: structlog.typing.FilteringBoundLogger,
+) -> tuple[list[bytes], int]:
+    # LRANGE + DEL in one MULTI: of several replicas polling at once,
+    # exactly one gets the list. Returns (fresh updates, stale count).
+    async with connection.pipeline(transaction=True) as pipe:
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        entries, _ = await pipe.execute()
+
+    now = time.time()
+    fresh: list[bytes] = []
+    stale = 0
+    for entry in entries:
+        # The list is already deleted: a foreign or truncated entry is
+        # skipped on its own instead of losing the rest of the batch.
+        stamp, separator, raw_update = entry.partition(b"\n")
+        try:
+            handed_off_at = float(stamp) if separator else math.nan
+        except ValueError:
+            handed_off_at = math.nan
+        if math.isnan(handed_off_at):
+            logger.warning("Skipping malformed handed-off entry", size=len(entry))
+            continue
+        if now - handed_off_at > max_age:
+            stale += 1
+        else:
+            fresh.append(raw_update)
+    return fresh, stale
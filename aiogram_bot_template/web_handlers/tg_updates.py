@@ -2,24 +2,34 @@ import secrets
 from typing import Any, TYPE_CHECKING
 
 import aiohttp.web
-import orjson
+import pydantic
 from aiogram import Bot, Dispatcher, types
 from aiohttp import web
 
 from aiogram_bot_template.data import config
 
 if TYPE_CHECKING:
-    import aiojobs
+    from aiogram_bot_template.utils.update_pool import UpdatePool
 
 tg_updates_app = web.Application()
 
 
 async def process_update(
-    upd: types.Update,
+    raw_update: bytes,
     bot: Bot,
     dp: Dispatcher,
     workflow_data: dict[str, Any],
 ) -> None:
+    # Parsing happens here rather than in the request handler, so Telegram
+    # gets its 200 without waiting on pydantic validation.
+    try:
+        upd = types.Update.model_validate_json(raw_update, context={"bot": bot})
+    except pydantic.ValidationError:
+        dp["aiogram_logger"].exception(
+            "Dropping malformed update",
+            raw_size=len(raw_update),
+        )
+        return
 
     await dp.feed_webhook_update(bot, upd, **workflow_data)
 
@@ -33,20 +43,17 @@ async def execute(req: web.Request) -> web.Response:
     if not secrets.compare_digest(req.match_info["bot_id"], config.BOT_ID):
         raise aiohttp.web.HTTPNotFound
 
-    dp: Dispatcher = req.app["dp"]
-    scheduler: aiojobs.Scheduler = req.app["scheduler"]
-    if scheduler.pending_count > config.MAX_UPDATES_IN_QUEUE:
-        raise web.HTTPTooManyRequests
-    if scheduler.closed:
+    update_pool: UpdatePool = req.app["update_pool"]
+    if update_pool.closed:
         raise web.HTTPServiceUnavailable(reason="Closed queue")
-    await scheduler.spawn(
-        process_update(
-            types.Update(**(await req.json(loads=orjson.loads))),
-            req.app["bot"],
-            dp,
-            {"dp": dp},
-        ),
-    )
+    if not update_pool.admit():
+        raise web.HTTPTooManyRequests
+    raw_update = await req.read()
+    try:
+        update_pool.submit(raw_update)
+    except RuntimeError:
+        # A drain started while the body was being read.
+        raise web.HTTPServiceUnavailable(reason="Closed queue") from None
 
     return web.Response()
 
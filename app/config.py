@@ -11,12 +11,35 @@ def _parse_allowed_users(raw: str) -> set[int]:
     }
 
 
+def _to_async_database_url(url: str) -> str:
+    for prefix in (
+        "postgresql+psycopg2://",
+        "postgresql+psycopg://",
+        "postgresql://",
+        "postgres://",
+    ):
+        if url.startswith(prefix):
+            url = "postgresql+asyncpg://" + url[len(prefix):]
+            break
+
+    # asyncpg понимает ssl=..., а не libpq-шный sslmode=...
+    return url.replace("sslmode=", "ssl=")
+
+
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 DATABASE_URL = os.getenv("DATABASE_URL", "").strip()
 ALLOWED_USERS = _parse_allowed_users(os.getenv("ALLOWED_USERS", ""))
+CATALOG_SEARCH_BACKEND = os.getenv("CATALOG_SEARCH_BACKEND", "memory").strip().lower()
+REDIS_URL = os.getenv("REDIS_URL", "").strip()
+FSM_TTL_SECONDS = int(os.getenv("FSM_TTL_SECONDS", "86400"))
 
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN is not set")
 
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL is not set")
+
+if CATALOG_SEARCH_BACKEND not in {"memory", "trgm"}:
+    raise ValueError("CATALOG_SEARCH_BACKEND must be 'memory' or 'trgm'")
+
+ASYNC_DATABASE_URL = _to_async_database_url(DATABASE_URL)
@@ -1,20 +1,21 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
 
-from app.config import DATABASE_URL
+from app.config import ASYNC_DATABASE_URL
+from app.db.pool import PoolSettings
 
-engine = create_engine(
-    DATABASE_URL,
+pool_settings = PoolSettings.from_env()
+
+engine = create_async_engine(
+    ASYNC_DATABASE_URL,
     echo=False,
-    future=True,
+    **pool_settings.engine_kwargs(is_async=True),
 )
 
-SessionLocal = sessionmaker(
+SessionLocal = async_sessionmaker(
     bind=engine,
     autoflush=False,
-    autocommit=False,
     expire_on_commit=False,
-    future=True,
 )
 
 Base = declarative_base()
@@ -0,0 +1,449 @@
+import logging
+from collections.abc import Awaitable, Callable
+
+from sqlalchemy import bindparam, func, select, text, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from app.config import CATALOG_SEARCH_BACKEND
+from app.db.base import Base
+from app.db import models  # noqa: F401
+from app.db.models import ArticleCounter, EquipmentModel, EquipmentUnit
+from app.utils.text import normalize_aliases, normalize_text, split_article_number
+
+
+logger = logging.getLogger(__name__)
+
+# Ключ pg_advisory_xact_lock: несколько реплик не накатывают шаги одновременно.
+MIGRATIONS_LOCK_KEY = 7_482_031_170
+
+Step = Callable[[AsyncConnection], Awaitable[None]]
+
+
+async def _execute_all(conn: AsyncConnection, *statements: str) -> None:
+    for statement in statements:
+        await conn.execute(text(statement))
+
+
+async def _create_tables(conn: AsyncConnection) -> None:
+    await conn.run_sync(Base.metadata.create_all)
+
+
+async def _legacy_columns(conn: AsyncConnection) -> None:
+    await _execute_all(
+        conn,
+        "ALTER TABLE equipment_models ADD COLUMN IF NOT EXISTS search_name TEXT",
+        "ALTER TABLE equipment_models ADD COLUMN IF NOT EXISTS is_active BOOLEAN NOT NULL DEFAULT TRUE",
+        "UPDATE equipment_models SET search_name = '' WHERE search_name IS NULL",
+        "ALTER TABLE orders ADD COLUMN IF NOT EXISTS start_at TIMESTAMP NULL",
+        "ALTER TABLE orders ADD COLUMN IF NOT EXISTS end_at TIMESTAMP NULL",
+        "ALTER TABLE orders ADD COLUMN IF NOT EXISTS subtotal NUMERIC(12,2) NOT NULL DEFAULT 0",
+        "ALTER TABLE orders ADD COLUMN IF NOT EXISTS discount_percent NUMERIC(5,2) NOT NULL DEFAULT 0",
+        "ALTER TABLE equipment_units ADD COLUMN IF NOT EXISTS defects TEXT",
+        "ALTER TABLE equipment_units ADD COLUMN IF NOT EXISTS article_number TEXT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_equipment_units_article_number_idx "
+        "ON equipment_units (article_number)",
+    )
+
+
+async def _unit_search_columns(conn: AsyncConnection) -> None:
+    await _execute_all(
+        conn,
+        "ALTER TABLE equipment_units ADD COLUMN IF NOT EXISTS article_search TEXT",
+        "ALTER TABLE equipment_units ADD COLUMN IF NOT EXISTS internal_search TEXT",
+        "CREATE INDEX IF NOT EXISTS ix_equipment_units_article_search "
+        "ON equipment_units (article_search text_pattern_ops)",
+        "CREATE INDEX IF NOT EXISTS ix_equipment_units_internal_search "
+        "ON equipment_units (internal_search text_pattern_ops)",
+    )
+
+    units = EquipmentUnit.__table__
+    rows = (
+        await conn.execute(
+            select(units.c.id, units.c.article_number, units.c.internal_number)
+            .where(units.c.internal_search.is_(None))
+        )
+    ).all()
+    if not rows:
+        return
+
+    stmt = (
+        update(units)
+        .where(units.c.id == bindparam("unit_id"))
+        .values(
+            article_search=bindparam("article_value"),
+            internal_search=bindparam("internal_value"),
+        )
+    )
+    await conn.execute(
+        stmt,
+        [
+            {
+                "unit_id": unit_id,
+                "article_value": normalize_text(article_number or "") or None,
+                "internal_value": normalize_text(internal_number or ""),
+            }
+            for unit_id, article_number, internal_number in rows
+        ],
+    )
+
+
+async def _order_items_order_id_index(conn: AsyncConnection) -> None:
+    await _execute_all(
+        conn,
+        "CREATE INDEX IF NOT EXISTS ix_order_items_order_id ON order_items (order_id)",
+    )
+
+
+async def _order_number_sequence(conn: AsyncConnection) -> None:
+    await _execute_all(
+        conn,
+        "CREATE SEQUENCE IF NOT EXISTS orders_order_number_seq",
+        "ALTER TABLE orders ALTER COLUMN order_number "
+        "SET DEFAULT nextval('orders_order_number_seq')",
+        # Двигаем sequence за уже выданные номера, но никогда не назад.
+        "SELECT setval('orders_order_number_seq', COALESCE(MAX(order_number), 0) + 1, false) "
+        "FROM orders "
+        "HAVING COALESCE(MAX(order_number), 0) >= "
+        "(SELECT last_value FROM orders_order_number_seq)",
+    )
+
+
+async def _article_counters_backfill(conn: AsyncConnection) -> None:
+    await _execute_all(
+        conn,
+        "INSERT INTO article_counters (prefix, last_value) "
+        "SELECT upper(left(article_number, 1)), "
+        "max(CAST(NULLIF(regexp_replace(article_number, '[^0-9]', '', 'g'), '') AS INTEGER)) "
+        "FROM equipment_units "
+        "WHERE article_number ~ '^[A-Za-z]' "
+        "GROUP BY 1 "
+        "HAVING max(CAST(NULLIF(regexp_replace(article_number, '[^0-9]', '', 'g'), '') AS INTEGER)) IS NOT NULL "
+        "ON CONFLICT (prefix) DO UPDATE "
+        "SET last_value = GREATEST(article_counters.last_value, EXCLUDED.last_value)",
+    )
+
+
+async def _booking_constraints(conn: AsyncConnection) -> None:
+    await _execute_all(
+        conn,
+        "CREATE INDEX IF NOT EXISTS ix_equipment_units_model_id_status "
+        "ON equipment_units (model_id, status)",
+        "CREATE INDEX IF NOT EXISTS ix_bookings_order_item_id ON bookings (order_item_id)",
+        # Одна единица не может быть в двух активных бронях на пересекающиеся
+        # даты; GiST-индекс ограничения обслуживает и проверки доступности.
+        "CREATE EXTENSION IF NOT EXISTS btree_gist",
+        "DO $$ BEGIN "
+        "IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'ex_bookings_unit_period') THEN "
+        "ALTER TABLE bookings ADD CONSTRAINT ex_bookings_unit_period "
+        "EXCLUDE USING gist ("
+        "equipment_unit_id WITH =, "
+        "daterange(start_date, end_date, '[]') WITH &&"
+        ") WHERE (status NOT IN ('cancelled', 'returned')); "
+        "END IF; "
+        "END $$",
+    )
+
+
+async def _app_settings(conn: AsyncConnection) -> None:
+    await _execute_all(
+        conn,
+        "CREATE TABLE IF NOT EXISTS app_settings ("
+        "key TEXT PRIMARY KEY, "
+        "value TEXT NOT NULL, "
+        "updated_at TIMESTAMPTZ NOT NULL DEFAULT now()"
+        ")",
+    )
+
+
+async def _catalog_trgm(conn: AsyncConnection) -> None:
+    # Шаг есть в журнале любой базы, а индексы строятся там, где pg_trgm
+    # доступен, — независимо от CATALOG_SEARCH_BACKEND, чтобы переключение
+    # на trgm не требовало отдельной миграции.
+    available = (
+        await conn.execute(
+            text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        )
+    ).first()
+    if available is None:
+        if CATALOG_SEARCH_BACKEND == "trgm":
+            raise RuntimeError("CATALOG_SEARCH_BACKEND is trgm, but pg_trgm is not available")
+        logger.warning("pg_trgm is not available, skipping trigram indexes")
+        return
+
+    await _execute_all(
+        conn,
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        "CREATE INDEX IF NOT EXISTS ix_equipment_models_search_name_trgm "
+        "ON equipment_models USING gin (search_name gin_trgm_ops)",
+        "CREATE INDEX IF NOT EXISTS ix_equipment_models_aliases "
+        "ON equipment_models USING gin (aliases)",
+    )
+
+
+BACKFILL_BATCH = 1000
+
+_SEARCH_NAME_BACKFILL = (
+    "UPDATE equipment_models SET search_name = normalize_search_text(name) "
+    "WHERE id IN ("
+    "SELECT id FROM equipment_models "
+    "WHERE search_name IS DISTINCT FROM normalize_search_text(name) "
+    "LIMIT :batch"
+    ")"
+)
+# SET article_number = article_number только будит триггер единиц.
+_UNIT_SEARCH_BACKFILL = (
+    "UPDATE equipment_units SET article_number = article_number "
+    "WHERE id IN ("
+    "SELECT id FROM equipment_units "
+    "WHERE article_search IS DISTINCT FROM "
+    "NULLIF(normalize_search_text(article_number), '') "
+    "OR internal_search IS DISTINCT FROM normalize_search_text(internal_number) "
+    "LIMIT :batch"
+    ")"
+)
+
+
+async def _search_name_trigger(conn: AsyncConnection) -> None:
+    # normalize_search_text повторяет app.utils.text.normalize_text:
+    # lower, ё -> е, кириллическая х -> латинская x, всё кроме [a-zа-я0-9]
+    # схлопывается в один пробел (тире при этом тоже уходят в пробел).
+    await _execute_all(
+        conn,
+        "CREATE OR REPLACE FUNCTION normalize_search_text(value TEXT) RETURNS TEXT "
+        "LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$ "
+        "SELECT btrim(regexp_replace("
+        "translate(lower(coalesce(value, '')), 'ёх', 'еx'), "
+        "'[^a-zа-я0-9]+', ' ', 'g'"
+        ")) "
+        "$$",
+        "CREATE OR REPLACE FUNCTION equipment_models_set_search_name() RETURNS trigger "
+        "LANGUAGE plpgsql AS $$ "
+        "BEGIN "
+        "NEW.search_name := normalize_search_text(NEW.name); "
+        "RETURN NEW; "
+        "END "
+        "$$",
+        "DROP TRIGGER IF EXISTS trg_equipment_models_search_name ON equipment_models",
+        "CREATE TRIGGER trg_equipment_models_search_name "
+        "BEFORE INSERT OR UPDATE OF name, search_name ON equipment_models "
+        "FOR EACH ROW EXECUTE FUNCTION equipment_models_set_search_name()",
+    )
+
+    await _backfill_in_batches(conn, _SEARCH_NAME_BACKFILL)
+
+
+async def _backfill_in_batches(conn: AsyncConnection, statement: str) -> None:
+    # Досчитываем только устаревшие строки, пачками: каждый UPDATE короткий,
+    # а на актуальных данных шаг сводится к одному пустому проходу.
+    stmt = text(statement)
+    while True:
+        result = await conn.execute(stmt, {"batch": BACKFILL_BATCH})
+        if result.rowcount < BACKFILL_BATCH:
+            break
+
+
+async def _unit_search_trigger(conn: AsyncConnection) -> None:
+    # Поля поиска единиц раньше писал только create_unit; теперь их держит
+    # триггер, как search_name у моделей (normalize_search_text из 0010).
+    await _execute_all(
+        conn,
+        "CREATE OR REPLACE FUNCTION equipment_units_set_search() RETURNS trigger "
+        "LANGUAGE plpgsql AS $$ "
+        "BEGIN "
+        "NEW.article_search := NULLIF(normalize_search_text(NEW.article_number), ''); "
+        "NEW.internal_search := normalize_search_text(NEW.internal_number); "
+        "RETURN NEW; "
+        "END "
+        "$$",
+        "DROP TRIGGER IF EXISTS trg_equipment_units_search ON equipment_units",
+        "CREATE TRIGGER trg_equipment_units_search "
+        "BEFORE INSERT OR UPDATE OF article_number, internal_number, "
+        "article_search, internal_search ON equipment_units "
+        "FOR EACH ROW EXECUTE FUNCTION equipment_units_set_search()",
+    )
+    await _backfill_in_batches(conn, _UNIT_SEARCH_BACKFILL)
+
+
+async def _search_text_case_folding(conn: AsyncConnection) -> None:
+    # lower() следует LC_CTYPE базы: под C/POSIX он не трогает кириллицу,
+    # а Python-овский normalize_text её понижает. Заглавную кириллицу
+    # переводим явно через translate (заодно Ё -> е и Х -> x), lower()
+    # остаётся только для латиницы, где от локали не зависит.
+    await _execute_all(
+        conn,
+        "CREATE OR REPLACE FUNCTION normalize_search_text(value TEXT) RETURNS TEXT "
+        "LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$ "
+        "SELECT btrim(regexp_replace("
+        "translate(lower(coalesce(value, '')), "
+        "'АБВГДЕЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯЁёх', "
+        "'абвгдежзийклмнопрстуфxцчшщъыьэюяееx'), "
+        "'[^a-zа-я0-9]+', ' ', 'g'"
+        ")) "
+        "$$",
+    )
+    # Под C-локалью ранее записанные значения могли разойтись с Python.
+    await _backfill_in_batches(conn, _SEARCH_NAME_BACKFILL)
+    await _backfill_in_batches(conn, _UNIT_SEARCH_BACKFILL)
+
+
+async def _normalize_aliases(conn: AsyncConnection) -> None:
+    # Поиск по алиасам (и GIN-индекс в режиме trgm) сравнивает с уже
+    # нормализованным запросом; старые строки писались без нормализации.
+    models = EquipmentModel.__table__
+    rows = (await conn.execute(select(models.c.id, models.c.aliases))).all()
+    changed = [
+        {"model_id": model_id, "aliases_value": normalized}
+        for model_id, aliases in rows
+        if (normalized := normalize_aliases(aliases)) != list(aliases or [])
+    ]
+    if not changed:
+        return
+
+    stmt = (
+        update(models)
+        .where(models.c.id == bindparam("model_id"))
+        .values(aliases=bindparam("aliases_value"))
+    )
+    await conn.execute(stmt, changed)
+
+
+async def _article_counters_rescan(conn: AsyncConnection) -> None:
+    # 0006 брал только латинские префиксы, а split_article_number (им же
+    # двигает счётчик create_unit) принимает любую букву, в том числе
+    # кириллицу. Пересчитываем тем же правилом; счётчик только растёт.
+    units = EquipmentUnit.__table__
+    rows = await conn.execute(
+        select(units.c.article_number).where(units.c.article_number.is_not(None))
+    )
+    last_values: dict[str, int] = {}
+    for (article_number,) in rows:
+        parts = split_article_number(article_number)
+        if parts is None:
+            continue
+        prefix, number = parts
+        last_values[prefix] = max(number, last_values.get(prefix, 0))
+    if not last_values:
+        return
+
+    counters = ArticleCounter.__table__
+    stmt = insert(counters).values(
+        prefix=bindparam("prefix_value"),
+        last_value=bindparam("last_value_value"),
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[counters.c.prefix],
+        set_={"last_value": func.greatest(counters.c.last_value, stmt.excluded.last_value)},
+    )
+    await conn.execute(
+        stmt,
+        [
+            {"prefix_value": prefix, "last_value_value": last_value}
+            for prefix, last_value in last_values.items()
+        ],
+    )
+
+
+# Порядок важен; применённые шаги не менять — для правок схемы
+# добавляйте новый шаг в конец. Переименованная версия попадает
+# в RENAMED_VERSIONS, чтобы журнал уже обновлённых баз совпал с новым.
+MIGRATIONS: list[tuple[str, Step]] = [
+    ("0001_create_tables", _create_tables),
+    ("0002_legacy_columns", _legacy_columns),
+    ("0003_unit_search_columns", _unit_search_columns),
+    ("0004_order_items_order_id_index", _order_items_order_id_index),
+    ("0005_order_number_sequence", _order_number_sequence),
+    ("0006_article_counters_backfill", _article_counters_backfill),
+    ("0007_booking_constraints", _booking_constraints),
+    ("0008_app_settings", _app_settings),
+    ("0009_search_name_trigger", _search_name_trigger),
+    ("0010_normalize_aliases", _normalize_aliases),
+    ("0011_unit_search_trigger", _unit_search_trigger),
+    ("0012_catalog_trgm", _catalog_trgm),
+    ("0013_search_text_case_folding", _search_text_case_folding),
+    ("0014_article_counters_rescan", _article_counters_rescan),
+]
+
+# Старая версия -> новая. Шаг catalog_trgm раньше регистрировался только
+# в режиме trgm, сначала как 0009, затем как 0013.
+RENAMED_VERSIONS: dict[str, str] = {
+    "0009_catalog_trgm": "0012_catalog_trgm",
+    "0010_search_name_trigger": "0009_search_name_trigger",
+    "0011_normalize_aliases": "0010_normalize_aliases",
+    "0012_unit_search_trigger": "0011_unit_search_trigger",
+    "0013_catalog_trgm": "0012_catalog_trgm",
+}
+
+
+async def _rename_versions(conn: AsyncConnection) -> None:
+    # Сначала все старые версии уходят во временные имена: цепочка
+    # 0010 -> 0009, 0009 -> 0012 иначе столкнулась бы по первичному ключу.
+    # Дубли (0009 и 0013 для catalog_trgm) схлопываются в одну запись.
+    for old, new in RENAMED_VERSIONS.items():
+        await conn.execute(
+            text(
+                "UPDATE schema_migrations SET version = :tmp WHERE version = :old "
+                "AND NOT EXISTS (SELECT 1 FROM schema_migrations WHERE version = :tmp)"
+            ),
+            {"old": old, "tmp": f"renamed:{new}"},
+        )
+        await conn.execute(
+            text("DELETE FROM schema_migrations WHERE version = :old"),
+            {"old": old},
+        )
+    await conn.execute(
+        text(
+            "UPDATE schema_migrations SET version = substr(version, 9) "
+            "WHERE version LIKE 'renamed:%' "
+            "AND substr(version, 9) NOT IN (SELECT version FROM schema_migrations)"
+        )
+    )
+    await conn.execute(text("DELETE FROM schema_migrations WHERE version LIKE 'renamed:%'"))
+
+
+async def _applied_versions(engine: AsyncEngine) -> set[str] | None:
+    # Быстрый путь: один SELECT по первичному ключу журнала, без транзакции.
+    try:
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            rows = await conn.execute(text("SELECT version FROM schema_migrations"))
+            return {version for (version,) in rows}
+    except DBAPIError:
+        return None
+
+
+async def run_migrations(engine: AsyncEngine) -> list[str]:
+    applied = await _applied_versions(engine)
+    if applied is not None and all(version in applied for version, _ in MIGRATIONS):
+        return []
+
+    done: list[str] = []
+    async with engine.begin() as conn:
+        await conn.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"),
+            {"key": MIGRATIONS_LOCK_KEY},
+        )
+        await conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version TEXT PRIMARY KEY, "
+            "applied_at TIMESTAMPTZ NOT NULL DEFAULT now()"
+            ")"
+        ))
+        await _rename_versions(conn)
+        # Перечитываем под блокировкой: другая реплика могла успеть раньше.
+        rows = await conn.execute(text("SELECT version FROM schema_migrations"))
+        applied = {version for (version,) in rows}
+
+        for version, step in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info("Applying migration %s", version)
+            await step(conn)
+            await conn.execute(
+                text("INSERT INTO schema_migrations (version) VALUES (:version)"),
+                {"version": version},
+            )
+            done.append(version)
+
+    return done
@@ -7,12 +7,15 @@ from sqlalchemy import (
     Date,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     Numeric,
+    Sequence,
     String,
     Text,
     UniqueConstraint,
     func,
+    text,
 )
 from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import Mapped, mapped_column, relationship
@@ -20,6 +23,12 @@ from sqlalchemy.orm import Mapped, mapped_column, relationship
 from app.db.base import Base
 
 
+order_number_seq = Sequence("orders_order_number_seq", metadata=Base.metadata)
+
+AVAILABLE_UNIT_STATUS = "ok"
+RELEASED_BOOKING_STATUSES = ("cancelled", "returned")
+
+
 class Client(Base):
     __tablename__ = "clients"
 
@@ -54,6 +63,8 @@ class EquipmentModel(Base):
     name: Mapped[str] = mapped_column(Text, nullable=False)
     category: Mapped[str] = mapped_column(Text, nullable=False)
 
+    # Заполняет триггер trg_equipment_models_search_name через
+    # normalize_search_text(name) — SQL-копию app.utils.text.normalize_text.
     search_name: Mapped[str] = mapped_column(Text, nullable=False, default="")
     is_active: Mapped[bool] = mapped_column(Boolean, nullable=False, default=True)
 
@@ -89,6 +100,17 @@ class EquipmentUnit(Base):
         UniqueConstraint("serial_number", name="uq_equipment_units_serial_number"),
         UniqueConstraint("article_number", name="uq_equipment_units_article_number"),
         CheckConstraint("shifts_total >= 0", name="chk_equipment_units_shifts_total"),
+        Index(
+            "ix_equipment_units_article_search",
+            "article_search",
+            postgresql_ops={"article_search": "text_pattern_ops"},
+        ),
+        Index(
+            "ix_equipment_units_internal_search",
+            "internal_search",
+            postgresql_ops={"internal_search": "text_pattern_ops"},
+        ),
+        Index("ix_equipment_units_model_id_status", "model_id", "status"),
     )
 
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
@@ -102,6 +124,11 @@ class EquipmentUnit(Base):
     serial_number: Mapped[str | None] = mapped_column(Text, nullable=True)
     article_number: Mapped[str | None] = mapped_column(Text, nullable=True)
 
+    # Заполняет триггер trg_equipment_units_search из article_number
+    # и internal_number — при любой записи, не только из create_unit.
+    article_search: Mapped[str | None] = mapped_column(Text, nullable=True)
+    internal_search: Mapped[str | None] = mapped_column(Text, nullable=True)
+
     purchase_price: Mapped[float] = mapped_column(
         Numeric(12, 2), nullable=False, default=0
     )
@@ -133,6 +160,25 @@ class EquipmentUnit(Base):
     bookings = relationship("Booking", back_populates="equipment_unit")
 
 
+class ArticleCounter(Base):
+    __tablename__ = "article_counters"
+
+    prefix: Mapped[str] = mapped_column(String(8), primary_key=True)
+    last_value: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+class AppSetting(Base):
+    __tablename__ = "app_settings"
+
+    key: Mapped[str] = mapped_column(Text, primary_key=True)
+    value: Mapped[str] = mapped_column(Text, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        nullable=False,
+    )
+
+
 class Order(Base):
     __tablename__ = "orders"
     __table_args__ = (
@@ -140,10 +186,15 @@ class Order(Base):
         CheckConstraint("shifts > 0", name="chk_orders_shifts"),
         CheckConstraint("end_date >= start_date", name="chk_orders_date_range"),
     )
+    __mapper_args__ = {"eager_defaults": True}
 
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
 
-    order_number: Mapped[int] = mapped_column(Integer, nullable=False)
+    order_number: Mapped[int] = mapped_column(
+        Integer,
+        server_default=text("nextval('orders_order_number_seq')"),
+        nullable=False,
+    )
 
     project_name: Mapped[str] = mapped_column(Text, nullable=False)
 
@@ -216,6 +267,7 @@ class OrderItem(Base):
     __tablename__ = "order_items"
     __table_args__ = (
         CheckConstraint("qty > 0", name="chk_order_items_qty"),
+        Index("ix_order_items_order_id", "order_id"),
     )
 
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
@@ -250,6 +302,9 @@ class Booking(Base):
     __tablename__ = "bookings"
     __table_args__ = (
         CheckConstraint("end_date >= start_date", name="chk_bookings_date_range"),
+        Index("ix_bookings_order_item_id", "order_item_id"),
+        # ex_bookings_unit_period (EXCLUDE USING gist, нужен btree_gist)
+        # создаётся миграцией 0007_booking_constraints.
     )
 
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name: str, default: int) -> int:
+    raw = os.getenv(name, "").strip()
+    return int(raw) if raw else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    raw = os.getenv(name, "").strip().lower()
+    if not raw:
+        return default
+    return raw in {"1", "true", "yes", "on"}
+
+
+# Один набор настроек пула для app/ (asyncpg) и для legacy db.py (sync).
+# Физически пулы разные — драйверы разные, — поэтому на реплику приходится
+# до (DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW) соединений на каждый стек:
+# это число и умножаем на количество реплик при сверке с max_connections.
+class PoolSettings:
+    def __init__(
+        self,
+        size: int = 5,
+        max_overflow: int = 5,
+        timeout: int = 30,
+        recycle: int = 1800,
+        pre_ping: bool = True,
+        statement_cache_size: int = 100,
+    ) -> None:
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.pre_ping = pre_ping
+        self.statement_cache_size = statement_cache_size
+
+    @classmethod
+    def from_env(cls) -> "PoolSettings":
+        return cls(
+            size=_env_int("DB_POOL_SIZE", 5),
+            max_overflow=_env_int("DB_POOL_MAX_OVERFLOW", 5),
+            timeout=_env_int("DB_POOL_TIMEOUT", 30),
+            recycle=_env_int("DB_POOL_RECYCLE", 1800),
+            pre_ping=_env_bool("DB_POOL_PRE_PING", True),
+            # 0 — без prepared statements (нужно за pgbouncer в transaction mode).
+            statement_cache_size=_env_int("DB_STATEMENT_CACHE_SIZE", 100),
+        )
+
+    def engine_kwargs(self, *, is_async: bool) -> dict:
+        kwargs = {
+            "poolclass": InstrumentedAsyncPool if is_async else InstrumentedPool,
+            "pool_size": self.size,
+            "max_overflow": self.max_overflow,
+            "pool_timeout": self.timeout,
+            "pool_recycle": self.recycle,
+            "pool_pre_ping": self.pre_ping,
+        }
+        if is_async:
+            kwargs["connect_args"] = {
+                "prepared_statement_cache_size": self.statement_cache_size,
+                "statement_cache_size": self.statement_cache_size,
+            }
+        return kwargs
+
+
+class PoolMetrics:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.overflow_events = 0
+        self.timeouts = 0
+
+    def observe(self, wait: float, overflowed: bool) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            if overflowed:
+                self.overflow_events += 1
+
+    def observe_timeout(self, wait: float) -> None:
+        with self._lock:
+            self.timeouts += 1
+            self.wait_max = max(self.wait_max, wait)
+
+    def snapshot(self, pool: QueuePool, reset: bool = False) -> dict:
+        with self._lock:
+            data = {
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "overflow": max(pool.overflow(), 0),
+                "checkouts": self.checkouts,
+                "wait_avg_ms": (
+                    self.wait_total / self.checkouts * 1000 if self.checkouts else 0.0
+                ),
+                "wait_max_ms": self.wait_max * 1000,
+                "overflow_events": self.overflow_events,
+                "timeouts": self.timeouts,
+            }
+            if reset:
+                self.checkouts = 0
+                self.wait_total = 0.0
+                self.wait_max = 0.0
+                self.overflow_events = 0
+                self.timeouts = 0
+        return data
+
+
+class _InstrumentedPoolMixin:
+    # Меряем ожидание свободного соединения внутри QueuePool._do_get:
+    # сюда входит и ожидание в очереди, и открытие overflow-соединения.
+    metrics: PoolMetrics
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+    def _do_get(self):
+        overflow_before = self.overflow()
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.metrics.observe_timeout(time.perf_counter() - started)
+            raise
+        self.metrics.observe(
+            time.perf_counter() - started,
+            overflowed=self.overflow() > max(overflow_before, 0),
+        )
+        return connection
+
+
+class InstrumentedPool(_InstrumentedPoolMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncPool(_InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def _engine_pool(engine):
+    # AsyncEngine держит пул у sync_engine.
+    return getattr(engine, "sync_engine", engine).pool
+
+
+def pool_metrics(engine) -> dict:
+    pool = _engine_pool(engine)
+    metrics = getattr(pool, "metrics", None)
+    if metrics is None:
+        return {}
+    return metrics.snapshot(pool)
+
+
+async def log_pool_metrics(engine, interval: float | None = None) -> None:
+    # Периодически пишет метрики пула в лог (и обнуляет счётчики окна).
+    if interval is None:
+        interval = _env_int("DB_POOL_LOG_INTERVAL", 60)
+    if interval <= 0:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        pool = _engine_pool(engine)
+        metrics = getattr(pool, "metrics", None)
+        if metrics is None:
+            return
+        logger.info("db pool: %s", metrics.snapshot(pool, reset=True))
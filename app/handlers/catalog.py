@@ -83,9 +83,9 @@ async def addmodel_confirm(message: Message, state: FSMContext) -> None:
 
     data = await state.get_data()
 
-    with SessionLocal() as db:
+    async with SessionLocal() as db:
         try:
-            model = create_equipment_model(
+            model = await create_equipment_model(
                 db=db,
                 name=data["name"],
                 category=data["category"],
@@ -111,8 +111,8 @@ async def cmd_findmodel(message: Message, state: FSMContext) -> None:
 async def findmodel_query(message: Message, state: FSMContext) -> None:
     query = message.text.strip()
 
-    with SessionLocal() as db:
-        results = search_models(db, query=query, include_inactive=True, limit=5)
+    async with SessionLocal() as db:
+        results = await search_models(db, query=query, include_inactive=True, limit=5)
 
     if not results:
         await message.answer("Ничего не найдено.")
@@ -143,8 +143,8 @@ async def cmd_editmodel(message: Message, state: FSMContext) -> None:
 async def editmodel_query(message: Message, state: FSMContext) -> None:
     query = message.text.strip()
 
-    with SessionLocal() as db:
-        results = search_models(db, query=query, include_inactive=True, limit=5)
+    async with SessionLocal() as db:
+        results = await search_models(db, query=query, include_inactive=True, limit=5)
 
     if not results:
         await message.answer("Модель не найдена.")
@@ -217,9 +217,9 @@ async def editmodel_value(message: Message, state: FSMContext) -> None:
         await message.answer("Неверное значение.")
         return
 
-    with SessionLocal() as db:
+    async with SessionLocal() as db:
         try:
-            model = update_equipment_model(db, model_id=model_id, **kwargs)
+            model = await update_equipment_model(db, model_id=model_id, **kwargs)
         except ValueError as e:
             await message.answer(str(e))
             return
@@ -229,7 +229,7 @@ async def editmodel_value(message: Message, state: FSMContext) -> None:
             await state.clear()
             return
 
-        model = get_model_by_id(db, model_id)
+        model = await get_model_by_id(db, model_id)
 
     await state.clear()
     await message.answer("Модель обновлена.\n\n" + format_model_card(model))
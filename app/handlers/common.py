@@ -2,10 +2,12 @@ from aiogram import Router
 from aiogram.filters import Command
 from aiogram.types import Message
 from aiogram.fsm.context import FSMContext
+from sqlalchemy import select
 
 from app.catalog import REAL_CATALOG
 from app.db.base import SessionLocal
 from app.db.models import EquipmentModel
+from app.services.catalog_index import catalog_index
 
 router = Router()
 
@@ -25,13 +27,15 @@ async def cmd_cancel(message: Message, state: FSMContext) -> None:
 async def cmd_seed(message: Message) -> None:
     added = 0
 
-    with SessionLocal() as db:
+    async with SessionLocal() as db:
         for row in REAL_CATALOG:
             exists = (
-                db.query(EquipmentModel)
-                .filter(EquipmentModel.name.ilike(row["name"]))
-                .first()
-            )
+                await db.execute(
+                    select(EquipmentModel.id)
+                    .where(EquipmentModel.name.ilike(row["name"]))
+                    .limit(1)
+                )
+            ).scalar_one_or_none()
             if exists:
                 continue
 
@@ -45,6 +49,9 @@ async def cmd_seed(message: Message) -> None:
             db.add(model)
             added += 1
 
-        db.commit()
+        await db.commit()
+
+        if added:
+            await catalog_index.rebuild(db)
 
     await message.answer(f"Каталог загружен. Добавлено позиций: {added}")
@@ -1,3 +1,5 @@
+import hashlib
+import json
 from datetime import datetime
 
 from aiogram import F, Router
@@ -11,15 +13,16 @@ from aiogram.types import (
 )
 
 from app.db.base import SessionLocal
+from app.services.availability_service import find_conflicting_orders, find_shortages
 from app.services.client_service import get_or_create_client
-from app.services.inventory_service import search_models
+from app.services.catalog_index import catalog_index
+from app.services.inventory_service import get_models_by_ids, resolve_item_lines
+from app.services.order_card_cache import order_card_cache
 from app.services.order_service import (
-    add_order_item,
     create_order,
-    get_last_order,
+    get_last_order_head,
     get_order_by_id,
-    get_order_by_number,
-    recalc_order_totals,
+    get_order_head_by_number,
     replace_order_items,
     update_order_client,
     update_order_comment,
@@ -30,7 +33,11 @@ from app.services.order_service import (
 )
 from app.services.parser_service import parse_items_block
 from app.states import EditSavedOrderFlow, NewOrderFlow
-from app.utils.formatters import format_order_card, format_order_preview_with_items
+from app.utils.formatters import (
+    assemble_order_card,
+    format_order_card_parts,
+    format_order_preview_with_items,
+)
 from app.utils.validators import (
     calc_shifts,
     parse_datetime_flexible,
@@ -150,67 +157,200 @@ async def send_preview(message: Message, state: FSMContext) -> None:
     start_at = datetime.fromisoformat(data["start_at_iso"])
     end_at = datetime.fromisoformat(data["end_at_iso"])
 
+    shifts = int(data["shifts"])
+    items = draft_quote_items(data)
+    found_items, subtotal = await hydrate_quote_items(items, shifts)
+    names = {item["model_id"]: item["name"] for item in found_items}
+
+    discount_percent = float(data.get("discount_percent", 0))
+    client_total = subtotal - (subtotal * discount_percent / 100)
+
+    async with SessionLocal() as db:
+        shortages = await find_shortages(
+            db,
+            [(item["model_id"], item["qty"]) for item in found_items],
+            start_at.date(),
+            end_at.date(),
+        )
+        # Не хватает единиц — показываем, какие сметы их держат на эти даты.
+        conflicting_orders = await find_conflicting_orders(
+            db,
+            [model_id for model_id, _, _ in shortages],
+            start_at.date(),
+            end_at.date(),
+        )
+
     preview = format_order_preview_with_items(
         project_name=data["project_name"],
         client_name=data["client_name"],
         start_at=start_at,
         end_at=end_at,
-        shifts=int(data["shifts"]),
-        found_items=data.get("found_items", []),
+        shifts=shifts,
+        found_items=found_items,
         not_found_items=data.get("not_found_items", []),
-        subtotal=float(data.get("subtotal", 0)),
-        discount_percent=float(data.get("discount_percent", 0)),
-        client_total=float(data.get("client_total", 0)),
+        subtotal=subtotal,
+        discount_percent=discount_percent,
+        client_total=client_total,
         subrental_total=float(data.get("subrental_total", 0)),
         comment=data.get("comment", ""),
+        shortages=[(names[model_id], qty, free) for model_id, qty, free in shortages],
+        conflicting_orders=conflicting_orders,
     )
 
+    # Запоминаем, какие названия и цены показаны: при подтверждении
+    # смета пересчитывается и сверяется с ними.
+    await state.update_data(items=items, quote_digest=quote_digest(found_items))
     await state.set_state(NewOrderFlow.confirm)
     await message.answer(preview, reply_markup=quote_preview_keyboard())
 
 
+async def cache_order_card(order) -> tuple[str, str]:
+    parts = format_order_card_parts(order)
+    await order_card_cache.put(
+        order.id,
+        order.updated_at,
+        parts,
+        {item.model_id for item in order.items},
+    )
+    return parts
+
+
+async def render_order_card(db, head) -> tuple[str, str] | None:
+    # head — (id, updated_at, status); агрегат грузим только при промахе кэша.
+    parts = await order_card_cache.get(head.id, head.updated_at)
+    if parts is not None:
+        return assemble_order_card(parts, head.status), head.status
+
+    order = await get_order_by_id(db, head.id)
+    if order is None:
+        return None
+    parts = await cache_order_card(order)
+    return assemble_order_card(parts, order.status), order.status
+
+
 async def send_saved_order(message: Message, order) -> None:
+    parts = await cache_order_card(order)
     await message.answer(
-        format_order_card(order),
+        assemble_order_card(parts, order.status),
         reply_markup=order_management_keyboard(order.id, order.status),
     )
 
 
+async def edit_order_card(callback: CallbackQuery, order_id: int, card) -> None:
+    if not card:
+        await callback.message.answer("Смета не найдена.")
+        return
+
+    text, status = card
+    await callback.message.edit_text(
+        text,
+        reply_markup=order_management_keyboard(order_id, status),
+    )
+
+
+async def resolve_quote_items(
+    parsed_items: list[tuple[str, int]],
+) -> tuple[list[list[int]], list[str]]:
+    # В FSM храним только [model_id, qty]: названия и цены подставляются
+    # при отрисовке, чтобы черновик не пересериализовывал их на каждом шаге.
+    async with SessionLocal() as db:
+        found, not_found_items = await resolve_item_lines(db, parsed_items)
+
+    return [[model.id, qty] for model, qty in found], not_found_items
+
+
+def draft_quote_items(data: dict) -> list[list[int]]:
+    if "items" in data:
+        return data["items"]
+    # Черновики, сохранённые до перехода на [model_id, qty], хранят found_items.
+    return [[item["model_id"], item["qty"]] for item in data.get("found_items", [])]
+
+
+def quote_digest(found_items: list[dict]) -> str:
+    payload = json.dumps(
+        [
+            [item["model_id"], item["qty"], item["name"], item["base_unit_price"]]
+            for item in found_items
+        ],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+async def hydrate_quote_items(
+    items: list[list[int]],
+    shifts: int,
+) -> tuple[list[dict], float]:
+    described = {model_id: catalog_index.describe(model_id) for model_id, _ in items}
+    missing = [model_id for model_id, info in described.items() if info is None]
+    if missing:
+        async with SessionLocal() as db:
+            for model in await get_models_by_ids(db, missing):
+                described[model.id] = (model.name, float(model.daily_rent_price))
+
+    found_items: list[dict] = []
+    subtotal = 0.0
+
+    for model_id, qty in items:
+        info = described.get(model_id)
+        if info is None:
+            continue
+
+        name, base_unit_price = info
+        unit_price_client = base_unit_price * shifts
+        line_total = unit_price_client * qty
+        subtotal += line_total
+
+        found_items.append(
+            {
+                "model_id": model_id,
+                "name": name,
+                "qty": qty,
+                "base_unit_price": base_unit_price,
+                "unit_price_client": unit_price_client,
+                "line_total": line_total,
+            }
+        )
+
+    return found_items, subtotal
+
+
 async def finalize_quote(message: Message, state: FSMContext) -> None:
     data = await state.get_data()
 
     start_at = datetime.fromisoformat(data["start_at_iso"])
     end_at = datetime.fromisoformat(data["end_at_iso"])
 
-    with SessionLocal() as db:
-        client = get_or_create_client(db, data["client_name"])
+    shifts = int(data["shifts"])
+    found_items, _ = await hydrate_quote_items(draft_quote_items(data), shifts)
+
+    if not found_items:
+        await message.answer("В смете нет ни одной позиции техники — измени список позиций.")
+        return
+
+    # Цены подставляются из каталога при отрисовке: если они поменялись после
+    # последнего просмотра, сначала показываем смету с новыми цифрами.
+    if data.get("quote_digest") != quote_digest(found_items):
+        await message.answer("Каталог изменился, проверь смету ещё раз.")
+        await send_preview(message, state)
+        return
+
+    async with SessionLocal() as db:
+        client = await get_or_create_client(db, data["client_name"])
 
-        order = create_order(
+        order = await create_order(
             db=db,
             project_name=data["project_name"],
             client_id=client.id,
             start_at=start_at,
             end_at=end_at,
-            shifts=int(data["shifts"]),
+            shifts=shifts,
             discount_percent=float(data.get("discount_percent", 0)),
             subrental_total=float(data.get("subrental_total", 0)),
             comment=data.get("comment", ""),
+            items_payload=found_items,
         )
 
-        for item in data.get("found_items", []):
-            add_order_item(
-                db=db,
-                order_id=order.id,
-                model_id=item["model_id"],
-                qty=item["qty"],
-                unit_price_client=item["unit_price_client"],
-                is_subrental=False,
-                subrental_cost=0,
-            )
-
-        recalc_order_totals(db, order.id)
-        order = get_order_by_number(db, order.order_number)
-
     await state.clear()
     await send_saved_order(message, order)
 
@@ -286,49 +426,7 @@ async def new_order_end_at(message: Message, state: FSMContext) -> None:
     )
 
     if edit_target == "dates":
-        raw_items = data.get("raw_items", "").strip()
-        found_items: list[dict] = []
-        not_found_items: list[str] = []
-        subtotal = 0.0
-
-        if raw_items:
-            parsed_items = parse_items_block(raw_items)
-
-            with SessionLocal() as db:
-                for raw_name, qty in parsed_items:
-                    results = search_models(db, query=raw_name, include_inactive=False, limit=5)
-
-                    if not results:
-                        not_found_items.append(raw_name)
-                        continue
-
-                    model = results[0]
-                    base_unit_price = float(model.daily_rent_price)
-                    unit_price_client = base_unit_price * shifts
-                    line_total = unit_price_client * qty
-                    subtotal += line_total
-
-                    found_items.append(
-                        {
-                            "model_id": model.id,
-                            "name": model.name,
-                            "qty": qty,
-                            "base_unit_price": base_unit_price,
-                            "unit_price_client": unit_price_client,
-                            "line_total": line_total,
-                        }
-                    )
-
-        discount_percent = float(data.get("discount_percent", 0))
-        client_total = subtotal - (subtotal * discount_percent / 100)
-
-        await state.update_data(
-            found_items=found_items,
-            not_found_items=not_found_items,
-            subtotal=subtotal,
-            client_total=client_total,
-            edit_target="",
-        )
+        await state.update_data(edit_target="")
         await send_preview(message, state)
         return
 
@@ -351,46 +449,9 @@ async def new_order_items(message: Message, state: FSMContext) -> None:
         await message.answer(f"Ошибка в списке техники: {e}")
         return
 
-    shifts = int(data["shifts"])
-    found_items: list[dict] = []
-    not_found_items: list[str] = []
-    subtotal = 0.0
-
-    with SessionLocal() as db:
-        for raw_name, qty in parsed_items:
-            results = search_models(db, query=raw_name, include_inactive=False, limit=5)
-
-            if not results:
-                not_found_items.append(raw_name)
-                continue
-
-            model = results[0]
-            base_unit_price = float(model.daily_rent_price)
-            unit_price_client = base_unit_price * shifts
-            line_total = unit_price_client * qty
-            subtotal += line_total
-
-            found_items.append(
-                {
-                    "model_id": model.id,
-                    "name": model.name,
-                    "qty": qty,
-                    "base_unit_price": base_unit_price,
-                    "unit_price_client": unit_price_client,
-                    "line_total": line_total,
-                }
-            )
+    items, not_found_items = await resolve_quote_items(parsed_items)
 
-    discount_percent = float(data.get("discount_percent", 0))
-    client_total = subtotal - (subtotal * discount_percent / 100)
-
-    await state.update_data(
-        raw_items=raw_items,
-        found_items=found_items,
-        not_found_items=not_found_items,
-        subtotal=subtotal,
-        client_total=client_total,
-    )
+    await state.update_data(items=items, not_found_items=not_found_items)
 
     if edit_target == "items":
         await state.update_data(edit_target="")
@@ -415,13 +476,7 @@ async def new_order_discount_percent(message: Message, state: FSMContext) -> Non
         await message.answer("Неверный процент.")
         return
 
-    subtotal = float(data.get("subtotal", 0))
-    client_total = subtotal - (subtotal * discount_percent / 100)
-
-    await state.update_data(
-        discount_percent=discount_percent,
-        client_total=client_total,
-    )
+    await state.update_data(discount_percent=discount_percent)
 
     if edit_target == "discount_percent":
         await state.update_data(edit_target="")
@@ -485,8 +540,8 @@ async def quick_discount(callback: CallbackQuery, state: FSMContext) -> None:
     if current_state == EditSavedOrderFlow.discount_percent.state:
         order_id = data["edit_saved_order_id"]
 
-        with SessionLocal() as db:
-            order = update_order_discount(db, order_id, float(value))
+        async with SessionLocal() as db:
+            order = await update_order_discount(db, order_id, float(value))
 
         await state.clear()
 
@@ -500,14 +555,7 @@ async def quick_discount(callback: CallbackQuery, state: FSMContext) -> None:
 
     edit_target = data.get("edit_target")
 
-    discount_percent = float(value)
-    subtotal = float(data.get("subtotal", 0))
-    client_total = subtotal - (subtotal * discount_percent / 100)
-
-    await state.update_data(
-        discount_percent=discount_percent,
-        client_total=client_total,
-    )
+    await state.update_data(discount_percent=float(value))
 
     if edit_target == "discount_percent":
         await state.update_data(edit_target="")
@@ -546,8 +594,8 @@ async def quick_comment_dash(callback: CallbackQuery, state: FSMContext) -> None
     if current_state == EditSavedOrderFlow.comment.state:
         order_id = data["edit_saved_order_id"]
 
-        with SessionLocal() as db:
-            order = update_order_comment(db, order_id, "-")
+        async with SessionLocal() as db:
+            order = await update_order_comment(db, order_id, "-")
 
         await state.clear()
 
@@ -659,14 +707,16 @@ async def cmd_order(message: Message) -> None:
         await message.answer("Используй: /order 1")
         return
 
-    with SessionLocal() as db:
-        order = get_order_by_number(db, order_number)
+    async with SessionLocal() as db:
+        head = await get_order_head_by_number(db, order_number)
+        card = await render_order_card(db, head) if head else None
 
-    if not order:
+    if not card:
         await message.answer("Смета не найдена.")
         return
 
-    await send_saved_order(message, order)
+    text, status = card
+    await message.answer(text, reply_markup=order_management_keyboard(head.id, status))
 
 
 @router.callback_query(F.data.startswith("order_confirm_"))
@@ -674,17 +724,15 @@ async def order_confirm(callback: CallbackQuery) -> None:
     await callback.answer()
     order_id = parse_order_id_from_callback(callback.data)
 
-    with SessionLocal() as db:
-        order = update_order_status(db, order_id, "confirmed")
+    async with SessionLocal() as db:
+        try:
+            head = await update_order_status(db, order_id, "confirmed")
+        except ValueError as e:
+            await callback.message.answer(str(e))
+            return
+        card = await render_order_card(db, head) if head else None
 
-    if not order:
-        await callback.message.answer("Смета не найдена.")
-        return
-
-    await callback.message.edit_text(
-        format_order_card(order),
-        reply_markup=order_management_keyboard(order.id, order.status),
-    )
+    await edit_order_card(callback, order_id, card)
 
 
 @router.callback_query(F.data.startswith("order_done_"))
@@ -692,17 +740,11 @@ async def order_done(callback: CallbackQuery) -> None:
     await callback.answer()
     order_id = parse_order_id_from_callback(callback.data)
 
-    with SessionLocal() as db:
-        order = update_order_status(db, order_id, "done")
-
-    if not order:
-        await callback.message.answer("Смета не найдена.")
-        return
+    async with SessionLocal() as db:
+        head = await update_order_status(db, order_id, "done")
+        card = await render_order_card(db, head) if head else None
 
-    await callback.message.edit_text(
-        format_order_card(order),
-        reply_markup=order_management_keyboard(order.id, order.status),
-    )
+    await edit_order_card(callback, order_id, card)
 
 
 @router.callback_query(F.data.startswith("order_cancel_"))
@@ -710,17 +752,11 @@ async def order_cancel(callback: CallbackQuery) -> None:
     await callback.answer()
     order_id = parse_order_id_from_callback(callback.data)
 
-    with SessionLocal() as db:
-        order = update_order_status(db, order_id, "cancelled")
-
-    if not order:
-        await callback.message.answer("Смета не найдена.")
-        return
+    async with SessionLocal() as db:
+        head = await update_order_status(db, order_id, "cancelled")
+        card = await render_order_card(db, head) if head else None
 
-    await callback.message.edit_text(
-        format_order_card(order),
-        reply_markup=order_management_keyboard(order.id, order.status),
-    )
+    await edit_order_card(callback, order_id, card)
 
 
 def saved_order_editable(order) -> bool:
@@ -732,8 +768,8 @@ async def saved_edit_project(callback: CallbackQuery, state: FSMContext) -> None
     await callback.answer()
     order_id = parse_order_id_from_callback(callback.data)
 
-    with SessionLocal() as db:
-        order = get_order_by_id(db, order_id)
+    async with SessionLocal() as db:
+        order = await get_order_by_id(db, order_id)
 
     if not saved_order_editable(order):
         await callback.message.answer("Редактирование недоступно для этого статуса.")
@@ -751,8 +787,8 @@ async def saved_project_name(message: Message, state: FSMContext) -> None:
     data = await state.get_data()
     order_id = data["edit_saved_order_id"]
 
-    with SessionLocal() as db:
-        order = update_order_project_name(db, order_id, message.text.strip())
+    async with SessionLocal() as db:
+        order = await update_order_project_name(db, order_id, message.text.strip())
 
     await state.clear()
 
@@ -768,8 +804,8 @@ async def saved_edit_client(callback: CallbackQuery, state: FSMContext) -> None:
     await callback.answer()
     order_id = parse_order_id_from_callback(callback.data)
 
-    with SessionLocal() as db:
-        order = get_order_by_id(db, order_id)
+    async with SessionLocal() as db:
+        order = await get_order_by_id(db, order_id)
 
     if not saved_order_editable(order):
         await callback.message.answer("Редактирование недоступно для этого статуса.")
@@ -787,9 +823,9 @@ async def saved_client_name(message: Message, state: FSMContext) -> None:
     data = await state.get_data()
     order_id = data["edit_saved_order_id"]
 
-    with SessionLocal() as db:
-        client = get_or_create_client(db, message.text.strip())
-        order = update_order_client(db, order_id, client.id)
+    async with SessionLocal() as db:
+        client = await get_or_create_client(db, message.text.strip())
+        order = await update_order_client(db, order_id, client.id)
 
     await state.clear()
 
@@ -805,8 +841,8 @@ async def saved_edit_dates(callback: CallbackQuery, state: FSMContext) -> None:
     await callback.answer()
     order_id = parse_order_id_from_callback(callback.data)
 
-    with SessionLocal() as db:
-        order = get_order_by_id(db, order_id)
+    async with SessionLocal() as db:
+        order = await get_order_by_id(db, order_id)
 
     if not saved_order_editable(order):
         await callback.message.answer("Редактирование недоступно для этого статуса.")
@@ -845,8 +881,12 @@ async def saved_end_at(message: Message, state: FSMContext) -> None:
         await message.answer(str(e))
         return
 
-    with SessionLocal() as db:
-        order = update_order_datetimes(db, order_id, start_at, end_at, shifts)
+    async with SessionLocal() as db:
+        try:
+            order = await update_order_datetimes(db, order_id, start_at, end_at, shifts)
+        except ValueError as e:
+            await message.answer(str(e))
+            return
 
     await state.clear()
 
@@ -862,8 +902,8 @@ async def saved_edit_items(callback: CallbackQuery, state: FSMContext) -> None:
     await callback.answer()
     order_id = parse_order_id_from_callback(callback.data)
 
-    with SessionLocal() as db:
-        order = get_order_by_id(db, order_id)
+    async with SessionLocal() as db:
+        order = await get_order_by_id(db, order_id)
 
     if not saved_order_editable(order):
         await callback.message.answer("Редактирование недоступно для этого статуса.")
@@ -888,8 +928,8 @@ async def saved_items(message: Message, state: FSMContext) -> None:
         await message.answer(f"Ошибка в списке техники: {e}")
         return
 
-    with SessionLocal() as db:
-        order = get_order_by_id(db, order_id)
+    async with SessionLocal() as db:
+        order = await get_order_by_id(db, order_id)
 
         if not order:
             await state.clear()
@@ -897,34 +937,27 @@ async def saved_items(message: Message, state: FSMContext) -> None:
             return
 
         shifts = int(order.shifts)
-        payload: list[dict] = []
-        not_found: list[str] = []
-
-        for raw_name, qty in parsed_items:
-            results = search_models(db, query=raw_name, include_inactive=False, limit=5)
-
-            if not results:
-                not_found.append(raw_name)
-                continue
-
-            model = results[0]
-            base_unit_price = float(model.daily_rent_price)
-            unit_price_client = base_unit_price * shifts
-
-            payload.append(
-                {
-                    "model_id": model.id,
-                    "qty": qty,
-                    "unit_price_client": unit_price_client,
-                }
-            )
+        found, not_found = await resolve_item_lines(db, parsed_items)
+
+        payload = [
+            {
+                "model_id": model.id,
+                "qty": qty,
+                "unit_price_client": float(model.daily_rent_price) * shifts,
+            }
+            for model, qty in found
+        ]
 
         if not_found:
             text = "Не найдено:\n" + "\n".join(f"• {name}" for name in not_found)
             await message.answer(text)
             return
 
-        order = replace_order_items(db, order_id, payload)
+        try:
+            order = await replace_order_items(db, order_id, payload)
+        except ValueError as e:
+            await message.answer(str(e))
+            return
 
     await state.clear()
     await send_saved_order(message, order)
@@ -935,8 +968,8 @@ async def saved_edit_discount(callback: CallbackQuery, state: FSMContext) -> Non
     await callback.answer()
     order_id = parse_order_id_from_callback(callback.data)
 
-    with SessionLocal() as db:
-        order = get_order_by_id(db, order_id)
+    async with SessionLocal() as db:
+        order = await get_order_by_id(db, order_id)
 
     if not saved_order_editable(order):
         await callback.message.answer("Редактирование недоступно для этого статуса.")
@@ -963,8 +996,8 @@ async def saved_discount_percent(message: Message, state: FSMContext) -> None:
         await message.answer("Неверный процент.")
         return
 
-    with SessionLocal() as db:
-        order = update_order_discount(db, order_id, discount_percent)
+    async with SessionLocal() as db:
+        order = await update_order_discount(db, order_id, discount_percent)
 
     await state.clear()
 
@@ -980,8 +1013,8 @@ async def saved_edit_comment(callback: CallbackQuery, state: FSMContext) -> None
     await callback.answer()
     order_id = parse_order_id_from_callback(callback.data)
 
-    with SessionLocal() as db:
-        order = get_order_by_id(db, order_id)
+    async with SessionLocal() as db:
+        order = await get_order_by_id(db, order_id)
 
     if not saved_order_editable(order):
         await callback.message.answer("Редактирование недоступно для этого статуса.")
@@ -1002,8 +1035,8 @@ async def saved_comment(message: Message, state: FSMContext) -> None:
     data = await state.get_data()
     order_id = data["edit_saved_order_id"]
 
-    with SessionLocal() as db:
-        order = update_order_comment(db, order_id, message.text.strip())
+    async with SessionLocal() as db:
+        order = await update_order_comment(db, order_id, message.text.strip())
 
     await state.clear()
 
@@ -1016,11 +1049,16 @@ async def saved_comment(message: Message, state: FSMContext) -> None:
 
 @router.message(Command("last"))
 async def cmd_last(message: Message) -> None:
-    with SessionLocal() as db:
-        order = get_last_order(db)
+    async with SessionLocal() as db:
+        head = await get_last_order_head(db)
+        card = await render_order_card(db, head) if head else None
 
-    if not order:
+    if not head:
         await message.answer("Смет пока нет.")
         return
+    if not card:
+        await message.answer("Смета не найдена.")
+        return
 
-    await send_saved_order(message, order)
+    text, status = card
+    await message.answer(text, reply_markup=order_management_keyboard(head.id, status))
@@ -90,10 +90,10 @@ async def cmd_addunit(message: Message, state: FSMContext) -> None:
 async def addunit_model_query(message: Message, state: FSMContext) -> None:
     query = message.text.strip()
 
-    with SessionLocal() as db:
-        model = resolve_single_model(db, query)
+    async with SessionLocal() as db:
+        model = await resolve_single_model(db, query)
         if model:
-            article_number = generate_next_article(db, model.category)
+            article_number = await generate_next_article(db, model.category)
         else:
             article_number = None
 
@@ -106,6 +106,7 @@ async def addunit_model_query(message: Message, state: FSMContext) -> None:
         addunit_model_name=model.name,
         addunit_model_category=model.category,
         addunit_article_number=article_number,
+        addunit_article_auto=True,
         addunit_status="ok",
     )
     await state.set_state(AddUnitFlow.purchase_price)
@@ -172,14 +173,17 @@ async def addunit_article_number(message: Message, state: FSMContext) -> None:
         await message.answer("Артикул не может быть пустым.")
         return
 
-    with SessionLocal() as db:
-        exists = article_exists(db, article_number)
+    async with SessionLocal() as db:
+        exists = await article_exists(db, article_number)
 
     if exists:
         await message.answer("Такой артикул уже существует.")
         return
 
-    await state.update_data(addunit_article_number=article_number)
+    await state.update_data(
+        addunit_article_number=article_number,
+        addunit_article_auto=False,
+    )
     await send_addarticle_preview(message, state)
 
 
@@ -233,14 +237,18 @@ async def addarticle_confirm(callback: CallbackQuery, state: FSMContext) -> None
 
     data = await state.get_data()
 
-    with SessionLocal() as db:
+    async with SessionLocal() as db:
         try:
-            unit = create_unit(
+            unit = await create_unit(
                 db=db,
                 model_id=int(data["addunit_model_id"]),
                 purchase_price=float(data["addunit_purchase_price"]),
                 defects=data.get("addunit_defects", "-"),
-                article_number=data.get("addunit_article_number"),
+                article_number=(
+                    None
+                    if data.get("addunit_article_auto")
+                    else data.get("addunit_article_number")
+                ),
                 status=data.get("addunit_status", "ok"),
             )
         except ValueError as e:
@@ -267,8 +275,8 @@ async def cmd_findunit(message: Message, state: FSMContext) -> None:
 async def findunit_query(message: Message, state: FSMContext) -> None:
     query = message.text.strip()
 
-    with SessionLocal() as db:
-        units = search_units(db, query=query, limit=10)
+    async with SessionLocal() as db:
+        units = await search_units(db, query=query, limit=10)
 
     if not units:
         await message.answer("Ничего не найдено.")
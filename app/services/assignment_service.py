@@ -0,0 +1,237 @@
+from datetime import date, timedelta
+
+from sqlalchemy import and_, delete, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import (
+    AVAILABLE_UNIT_STATUS,
+    RELEASED_BOOKING_STATUSES,
+    Booking,
+    EquipmentModel,
+    EquipmentUnit,
+    Order,
+    OrderItem,
+)
+from app.services.occupancy_cache import occupancy_cache
+from app.services.unit_allocator import OPEN_GAP_DAYS, allocate_units
+
+
+# Изменение брони для карты занятости: (model_id, start, end, +1/-1).
+BookingChange = tuple[int, date, date, int]
+
+_ACTIVE = Booking.status.not_in(RELEASED_BOOKING_STATUSES)
+
+
+def apply_booking_changes(changes: list[BookingChange]) -> None:
+    # Вызывать после commit: в кэш попадают только сохранённые брони.
+    for model_id, start_date, end_date, delta in changes:
+        if delta > 0:
+            occupancy_cache.booking_added(model_id, start_date, end_date)
+        else:
+            occupancy_cache.booking_released(model_id, start_date, end_date)
+
+
+def _order_bookings(order_id: int, item_ids: list[int] | None = None):
+    criteria = and_(
+        Booking.order_item_id == OrderItem.id,
+        OrderItem.order_id == order_id,
+        EquipmentUnit.id == Booking.equipment_unit_id,
+        _ACTIVE,
+    )
+    if item_ids is not None:
+        criteria = and_(criteria, OrderItem.id.in_(item_ids))
+    return criteria
+
+
+_RETURNING = (EquipmentUnit.model_id, Booking.start_date, Booking.end_date)
+
+
+async def assign_order_units(db: AsyncSession, order_id: int) -> list[BookingChange]:
+    # Добирает единицы под позиции заказа (с учётом уже созданных броней)
+    # и создаёт Booking; без commit. ValueError, если единиц не хватает.
+    order = (
+        await db.execute(
+            select(Order.start_date, Order.end_date).where(Order.id == order_id)
+        )
+    ).one_or_none()
+    if order is None:
+        return []
+    start_date, end_date = order
+
+    booked = (
+        select(func.count())
+        .where(Booking.order_item_id == OrderItem.id, _ACTIVE)
+        .correlate(OrderItem)
+        .scalar_subquery()
+    )
+    items_stmt = (
+        select(OrderItem.id, OrderItem.model_id, OrderItem.qty - booked)
+        .where(OrderItem.order_id == order_id, OrderItem.is_subrental.is_(False))
+        .order_by(OrderItem.id)
+    )
+    missing = [
+        (item_id, model_id, qty)
+        for item_id, model_id, qty in (await db.execute(items_stmt)).all()
+        if qty > 0
+    ]
+    if not missing:
+        return []
+
+    model_ids = {model_id for _, model_id, _ in missing}
+
+    # Параллельное подтверждение смет с теми же моделями ждёт здесь, пока
+    # первая транзакция не закончится. Блокировка — отдельным запросом:
+    # в READ COMMITTED следующий SELECT берёт свежий снимок и видит брони,
+    # которые та транзакция успела закоммитить.
+    await db.execute(
+        select(EquipmentUnit.id)
+        .where(
+            EquipmentUnit.model_id.in_(model_ids),
+            EquipmentUnit.status == AVAILABLE_UNIT_STATUS,
+        )
+        .order_by(EquipmentUnit.id)
+        .with_for_update()
+    )
+
+    # Расписания кандидатов одним запросом: исправные единицы нужных моделей
+    # и их активные брони в окрестности заказа, уже отсортированные.
+    lookaround = timedelta(days=OPEN_GAP_DAYS)
+    fleet_stmt = (
+        select(EquipmentUnit.id, EquipmentUnit.model_id, Booking.start_date, Booking.end_date)
+        .outerjoin(
+            Booking,
+            and_(
+                Booking.equipment_unit_id == EquipmentUnit.id,
+                _ACTIVE,
+                Booking.end_date >= start_date - lookaround,
+                Booking.start_date <= end_date + lookaround,
+            ),
+        )
+        .where(
+            EquipmentUnit.model_id.in_(model_ids),
+            EquipmentUnit.status == AVAILABLE_UNIT_STATUS,
+        )
+        .order_by(EquipmentUnit.id, Booking.start_date)
+    )
+    fleet: dict[int, dict[int, list[tuple[int, int]]]] = {}
+    for unit_id, model_id, booked_from, booked_to in (await db.execute(fleet_stmt)).all():
+        intervals = fleet.setdefault(model_id, {}).setdefault(unit_id, [])
+        if booked_from is not None:
+            intervals.append((booked_from.toordinal(), booked_to.toordinal()))
+
+    start, end = start_date.toordinal(), end_date.toordinal()
+    assigned, shortages = allocate_units(
+        ((item_id, model_id, qty, start, end) for item_id, model_id, qty in missing),
+        fleet,
+    )
+
+    model_by_item = {item_id: model_id for item_id, model_id, _ in missing}
+    if shortages:
+        names = dict(
+            (
+                await db.execute(
+                    select(EquipmentModel.id, EquipmentModel.name).where(
+                        EquipmentModel.id.in_(set(model_by_item.values()))
+                    )
+                )
+            ).all()
+        )
+        details = ", ".join(
+            f"{names.get(model_by_item[item_id], model_by_item[item_id])}: "
+            f"нужно {qty}, свободно {found}"
+            for item_id, qty, found in shortages
+        )
+        raise ValueError(f"Не хватает свободных единиц: {details}")
+
+    rows = [
+        {
+            "order_item_id": item_id,
+            "equipment_unit_id": unit_id,
+            "start_date": start_date,
+            "end_date": end_date,
+            "status": "reserved",
+        }
+        for item_id, unit_ids in assigned.items()
+        for unit_id in unit_ids
+    ]
+    try:
+        await db.execute(insert(Booking), rows)
+    except IntegrityError as e:
+        # Страховка на случай брони, созданной в обход этой блокировки:
+        # ex_bookings_unit_period не даёт занять единицу дважды.
+        if "ex_bookings_unit_period" not in str(e.orig):
+            raise
+        raise ValueError(
+            "Единицы на эти даты только что заняла другая смета, попробуйте ещё раз"
+        ) from e
+
+    return [
+        (model_by_item[row["order_item_id"]], start_date, end_date, 1)
+        for row in rows
+    ]
+
+
+async def drop_order_bookings(
+    db: AsyncSession,
+    order_id: int,
+    item_ids: list[int] | None = None,
+) -> list[BookingChange]:
+    # Снимает активные брони заказа (или только указанных позиций):
+    # перед сменой дат и перед удалением позиций, чтобы кэш узнал об этом.
+    stmt = (
+        delete(Booking)
+        .where(_order_bookings(order_id, item_ids))
+        .returning(*_RETURNING)
+        .execution_options(synchronize_session=False)
+    )
+    result = await db.execute(stmt)
+    return [(model_id, s, e, -1) for model_id, s, e in result.all()]
+
+
+async def trim_order_bookings(db: AsyncSession, order_id: int) -> list[BookingChange]:
+    # Снимает лишние брони там, где количество в позиции уменьшилось.
+    ranked = (
+        select(
+            Booking.id,
+            OrderItem.qty,
+            func.row_number()
+            .over(partition_by=Booking.order_item_id, order_by=Booking.id.desc())
+            .label("rn"),
+        )
+        .join(OrderItem, OrderItem.id == Booking.order_item_id)
+        .where(OrderItem.order_id == order_id, _ACTIVE)
+        .subquery("ranked")
+    )
+    stmt = (
+        delete(Booking)
+        .where(
+            Booking.id == ranked.c.id,
+            ranked.c.rn > ranked.c.qty,
+            EquipmentUnit.id == Booking.equipment_unit_id,
+        )
+        .returning(*_RETURNING)
+        .execution_options(synchronize_session=False)
+    )
+    result = await db.execute(stmt)
+    return [(model_id, s, e, -1) for model_id, s, e in result.all()]
+
+
+async def release_order_bookings(
+    db: AsyncSession,
+    order_id: int,
+    status: str,
+) -> list[BookingChange]:
+    # Отмена/завершение: брони остаются в истории, но больше не занимают единицы.
+    if status not in RELEASED_BOOKING_STATUSES:
+        raise ValueError("Недопустимый статус брони")
+
+    stmt = (
+        update(Booking)
+        .where(_order_bookings(order_id))
+        .values(status=status)
+        .returning(*_RETURNING)
+        .execution_options(synchronize_session=False)
+    )
+    result = await db.execute(stmt)
+    return [(model_id, s, e, -1) for model_id, s, e in result.all()]
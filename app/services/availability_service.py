@@ -0,0 +1,123 @@
+from datetime import date
+
+from sqlalchemy import and_, bindparam, exists, func, literal_column, select
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.types import BigInteger
+
+from app.db.models import (
+    AVAILABLE_UNIT_STATUS,
+    RELEASED_BOOKING_STATUSES,
+    Booking,
+    EquipmentUnit,
+    Order,
+    OrderItem,
+)
+from app.services.occupancy_cache import occupancy_cache
+
+
+# Выражения совпадают с исключающим ограничением ex_bookings_unit_period
+# буквально (включая литералы), иначе планировщик не возьмёт его GiST-индекс.
+_BOOKING_PERIOD = func.daterange(
+    Booking.start_date,
+    Booking.end_date,
+    literal_column("'[]'"),
+)
+_BOOKING_ACTIVE = Booking.status.not_in(
+    [literal_column(f"'{status}'") for status in RELEASED_BOOKING_STATUSES]
+)
+
+
+def _overlaps(start_date: date, end_date: date):
+    period = func.daterange(start_date, end_date, literal_column("'[]'"))
+    return and_(_BOOKING_ACTIVE, _BOOKING_PERIOD.op("&&")(period))
+
+
+def _unit_is_booked(start_date: date, end_date: date):
+    return exists().where(
+        Booking.equipment_unit_id == EquipmentUnit.id,
+        _overlaps(start_date, end_date),
+    )
+
+
+async def free_units_by_model(
+    db: AsyncSession,
+    model_ids: list[int],
+    start_date: date,
+    end_date: date,
+) -> dict[int, int]:
+    # Один запрос на всю смету: исправные единицы без пересекающихся броней.
+    ids = sorted(set(model_ids))
+    if not ids:
+        return {}
+
+    stmt = (
+        select(EquipmentUnit.model_id, func.count())
+        .where(
+            EquipmentUnit.model_id == func.any(
+                bindparam("model_ids", ids, type_=ARRAY(BigInteger))
+            ),
+            EquipmentUnit.status == AVAILABLE_UNIT_STATUS,
+            ~_unit_is_booked(start_date, end_date),
+        )
+        .group_by(EquipmentUnit.model_id)
+    )
+    counts = dict((await db.execute(stmt)).all())
+    return {model_id: counts.get(model_id, 0) for model_id in ids}
+
+
+async def find_shortages(
+    db: AsyncSession,
+    requested: list[tuple[int, int]],
+    start_date: date,
+    end_date: date,
+) -> list[tuple[int, int, int]]:
+    # requested: [(model_id, qty)] -> [(model_id, qty, free)] там, где не хватает.
+    cached = occupancy_cache.shortages(requested, start_date, end_date)
+    if cached is not None:
+        return cached
+
+    wanted: dict[int, int] = {}
+    for model_id, qty in requested:
+        wanted[model_id] = wanted.get(model_id, 0) + qty
+
+    free = await free_units_by_model(db, list(wanted), start_date, end_date)
+    return [
+        (model_id, qty, free[model_id])
+        for model_id, qty in wanted.items()
+        if free[model_id] < qty
+    ]
+
+
+async def find_conflicting_orders(
+    db: AsyncSession,
+    model_ids: list[int],
+    start_date: date,
+    end_date: date,
+    exclude_order_id: int | None = None,
+) -> list[Order]:
+    # Заказы, чьи активные брони на единицы этих моделей пересекают период.
+    ids = sorted(set(model_ids))
+    if not ids:
+        return []
+
+    conflicting_ids = (
+        select(OrderItem.order_id)
+        .join(Booking, Booking.order_item_id == OrderItem.id)
+        .join(EquipmentUnit, EquipmentUnit.id == Booking.equipment_unit_id)
+        .where(
+            EquipmentUnit.model_id == func.any(
+                bindparam("model_ids", ids, type_=ARRAY(BigInteger))
+            ),
+            _overlaps(start_date, end_date),
+        )
+    )
+    if exclude_order_id is not None:
+        conflicting_ids = conflicting_ids.where(OrderItem.order_id != exclude_order_id)
+
+    stmt = (
+        select(Order)
+        .where(Order.id.in_(conflicting_ids))
+        .order_by(Order.start_date, Order.id)
+    )
+    return list((await db.execute(stmt)).scalars().all())
@@ -0,0 +1,193 @@
+from collections import defaultdict
+from collections.abc import Iterable
+from difflib import SequenceMatcher
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import EquipmentModel
+from app.utils.text import normalize_text
+
+
+FUZZY_THRESHOLD = 0.45
+NGRAM_SIZE = 3
+
+
+def _ngrams(value: str) -> set[str]:
+    if len(value) < NGRAM_SIZE:
+        return set()
+    return {value[i:i + NGRAM_SIZE] for i in range(len(value) - NGRAM_SIZE + 1)}
+
+
+# Процессный индекс по search_name: строится на старте и обновляется
+# при записи моделей, чтобы поиск не читал всю таблицу equipment_models.
+# Заодно держит название и цену за смену — из них собираются черновики смет.
+class CatalogIndex:
+    def __init__(self) -> None:
+        self._names: dict[int, str] = {}
+        self._prices: dict[int, float] = {}
+        self._search_names: dict[int, str] = {}
+        self._active: dict[int, bool] = {}
+        self._exact: dict[str, set[int]] = defaultdict(set)
+        self._model_aliases: dict[int, set[str]] = {}
+        self._aliases: dict[str, set[int]] = defaultdict(set)
+        self._ngrams: dict[str, set[int]] = defaultdict(set)
+        self._loaded = False
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def describe(self, model_id: int) -> tuple[str, float] | None:
+        name = self._names.get(model_id)
+        if name is None:
+            return None
+        return name, self._prices[model_id]
+
+    async def rebuild(self, db: AsyncSession) -> None:
+        stmt = select(
+            EquipmentModel.id,
+            EquipmentModel.name,
+            EquipmentModel.daily_rent_price,
+            EquipmentModel.search_name,
+            EquipmentModel.is_active,
+            EquipmentModel.aliases,
+        )
+        rows = (await db.execute(stmt)).all()
+
+        self._names.clear()
+        self._prices.clear()
+        self._search_names.clear()
+        self._active.clear()
+        self._exact.clear()
+        self._model_aliases.clear()
+        self._aliases.clear()
+        self._ngrams.clear()
+
+        for model_id, name, price, search_name, is_active, aliases in rows:
+            self._add(
+                model_id,
+                name,
+                float(price or 0),
+                search_name or "",
+                bool(is_active),
+                aliases or [],
+            )
+
+        self._loaded = True
+
+    def upsert(self, model: EquipmentModel) -> None:
+        # Незагруженный индекс (режим trgm) не наполняем по одной модели:
+        # describe() для неё иначе вернул бы данные, которые другой процесс
+        # мог уже поменять, вместо чтения из БД.
+        if self._loaded:
+            self._remove(model.id)
+            self._add(
+                model.id,
+                model.name,
+                float(model.daily_rent_price or 0),
+                model.search_name or "",
+                bool(model.is_active),
+                model.aliases or [],
+            )
+
+    def _add(
+        self,
+        model_id: int,
+        name: str,
+        price: float,
+        search_name: str,
+        is_active: bool,
+        aliases: list[str],
+    ) -> None:
+        self._names[model_id] = name
+        self._prices[model_id] = price
+        self._search_names[model_id] = search_name
+        self._active[model_id] = is_active
+        self._exact[search_name].add(model_id)
+
+        normalized_aliases = {a for a in (normalize_text(alias) for alias in aliases) if a}
+        self._model_aliases[model_id] = normalized_aliases
+        for alias in normalized_aliases:
+            self._aliases[alias].add(model_id)
+        for gram in _ngrams(search_name):
+            self._ngrams[gram].add(model_id)
+
+    def _remove(self, model_id: int) -> None:
+        search_name = self._search_names.pop(model_id, None)
+        self._names.pop(model_id, None)
+        self._prices.pop(model_id, None)
+        self._active.pop(model_id, None)
+        if search_name is None:
+            return
+
+        self._discard(self._exact, search_name, model_id)
+        for alias in self._model_aliases.pop(model_id, ()):
+            self._discard(self._aliases, alias, model_id)
+        for gram in _ngrams(search_name):
+            self._discard(self._ngrams, gram, model_id)
+
+    @staticmethod
+    def _discard(postings: dict[str, set[int]], key: str, model_id: int) -> None:
+        ids = postings.get(key)
+        if ids is None:
+            return
+        ids.discard(model_id)
+        if not ids:
+            del postings[key]
+
+    def _visible(self, ids: Iterable[int], include_inactive: bool) -> list[int]:
+        if include_inactive:
+            return sorted(ids)
+        return sorted(i for i in ids if self._active.get(i))
+
+    def containing(self, q: str, include_inactive: bool = True) -> list[int]:
+        # Только подстрока в search_name — без алиасов и нечёткого поиска.
+        grams = _ngrams(q)
+        if grams:
+            postings = sorted((self._ngrams.get(g, set()) for g in grams), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+        else:
+            # Слишком короткий запрос для n-грамм: проверяем имена в памяти.
+            candidates = set(self._search_names)
+
+        return [
+            i for i in self._visible(candidates, include_inactive)
+            if q in self._search_names[i]
+        ]
+
+    def search(self, q: str, include_inactive: bool = True, limit: int = 5) -> list[int]:
+        if not q:
+            return []
+
+        exact = self._visible(self._exact.get(q, ()), include_inactive)
+        if exact:
+            return exact[:1]
+
+        alias_hits = self._visible(self._aliases.get(q, ()), include_inactive)
+        if alias_hits:
+            return alias_hits[:1]
+
+        contains = self.containing(q, include_inactive)
+        if contains:
+            return contains[:limit]
+
+        # Нечёткий поиск — по всем моделям, как и раньше: общая n-грамма
+        # не обязательна для ratio >= порога ("fx3" и "fx 3" — 0.86 без единой
+        # общей триграммы). Дешёвые верхние оценки отсекают почти всё сразу.
+        scored = []
+        for model_id in self._visible(self._search_names, include_inactive):
+            matcher = SequenceMatcher(None, q, self._search_names[model_id])
+            if matcher.real_quick_ratio() < FUZZY_THRESHOLD:
+                continue
+            if matcher.quick_ratio() < FUZZY_THRESHOLD:
+                continue
+            ratio = matcher.ratio()
+            if ratio >= FUZZY_THRESHOLD:
+                scored.append((ratio, model_id))
+
+        scored.sort(key=lambda pair: pair[0], reverse=True)
+        return [model_id for _, model_id in scored[:limit]]
+
+
+catalog_index = CatalogIndex()
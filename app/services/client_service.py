@@ -1,16 +1,16 @@
 from sqlalchemy import select
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.db.models import Client
 
 
-def get_client_by_name(db: Session, name: str) -> Client | None:
+async def get_client_by_name(db: AsyncSession, name: str) -> Client | None:
     stmt = select(Client).where(Client.name.ilike(name.strip()))
-    return db.execute(stmt).scalar_one_or_none()
+    return (await db.execute(stmt)).scalar_one_or_none()
 
 
-def create_client(
-    db: Session,
+async def create_client(
+    db: AsyncSession,
     name: str,
     client_type: str = "person",
     phone: str | None = None,
@@ -27,13 +27,13 @@ def create_client(
         comment=comment,
     )
     db.add(client)
-    db.commit()
-    db.refresh(client)
+    await db.commit()
+    await db.refresh(client)
     return client
 
 
-def get_or_create_client(db: Session, name: str) -> Client:
-    existing = get_client_by_name(db, name)
+async def get_or_create_client(db: AsyncSession, name: str) -> Client:
+    existing = await get_client_by_name(db, name)
     if existing:
         return existing
-    return create_client(db=db, name=name)
+    return await create_client(db=db, name=name)
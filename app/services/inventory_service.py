@@ -1,42 +1,16 @@
-import re
-from difflib import SequenceMatcher
-
-from sqlalchemy import select
-from sqlalchemy.orm import Session
+from sqlalchemy import Text, and_, bindparam, case, cast, func, or_, select, true
+from sqlalchemy.dialects.postgresql import ARRAY, array
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.config import CATALOG_SEARCH_BACKEND
 from app.db.models import EquipmentModel
+from app.services.catalog_index import FUZZY_THRESHOLD, catalog_index
+from app.services.order_card_cache import order_card_cache
+from app.utils.text import normalize_aliases, normalize_text
 
 
-def normalize_text(value: str) -> str:
-    text = value.lower().strip()
-    text = text.replace("ё", "е")
-    text = text.replace("–", "-").replace("—", "-")
-    text = text.replace("х", "x")
-    text = re.sub(r"[^a-zа-я0-9]+", " ", text, flags=re.IGNORECASE)
-    text = re.sub(r"\s+", " ", text).strip()
-    return text
-
-
-def sync_search_names(db: Session) -> None:
-    models = db.execute(select(EquipmentModel)).scalars().all()
-    changed = False
-
-    for model in models:
-        normalized = normalize_text(model.name)
-        if model.search_name != normalized:
-            model.search_name = normalized
-            changed = True
-
-        if model.is_active is None:
-            model.is_active = True
-            changed = True
-
-    if changed:
-        db.commit()
-
-
-def create_equipment_model(
-    db: Session,
+async def create_equipment_model(
+    db: AsyncSession,
     name: str,
     category: str,
     daily_rent_price: float = 0,
@@ -46,9 +20,9 @@ def create_equipment_model(
 ) -> EquipmentModel:
     search_name = normalize_text(name)
 
-    existing = db.execute(
+    existing = (await db.execute(
         select(EquipmentModel).where(EquipmentModel.search_name == search_name)
-    ).scalar_one_or_none()
+    )).scalar_one_or_none()
 
     if existing:
         raise ValueError("Такая модель уже существует.")
@@ -56,25 +30,110 @@ def create_equipment_model(
     model = EquipmentModel(
         name=name.strip(),
         category=category.strip(),
-        search_name=search_name,
         is_active=True,
         daily_rent_price=daily_rent_price,
         estimated_value=estimated_value,
-        aliases=aliases or [],
+        aliases=normalize_aliases(aliases),
         comment=comment,
     )
     db.add(model)
-    db.commit()
-    db.refresh(model)
+    await db.commit()
+    await db.refresh(model)
+    catalog_index.upsert(model)
     return model
 
 
-def get_model_by_id(db: Session, model_id: int) -> EquipmentModel | None:
-    return db.get(EquipmentModel, model_id)
+async def get_model_by_id(db: AsyncSession, model_id: int) -> EquipmentModel | None:
+    return await db.get(EquipmentModel, model_id)
+
+
+async def get_models_by_ids(db: AsyncSession, model_ids: list[int]) -> list[EquipmentModel]:
+    if not model_ids:
+        return []
+
+    stmt = select(EquipmentModel).where(EquipmentModel.id.in_(model_ids))
+    by_id = {m.id: m for m in (await db.execute(stmt)).scalars().all()}
+    return [by_id[model_id] for model_id in model_ids if model_id in by_id]
+
+
+def _trgm_search_stmt(q, include_inactive: bool, limit: int):
+    search_name = EquipmentModel.search_name
+    # asyncpg приводит строковые параметры к VARCHAR, а text[] @> varchar[]
+    # в Postgres не определён — поэтому явный CAST к типу колонки.
+    alias_hit = EquipmentModel.aliases.contains(cast(array([q]), ARRAY(Text)))
+    similarity = func.similarity(search_name, q)
+    rank = case(
+        (search_name == q, 0),
+        (alias_hit, 1),
+        (search_name.contains(q), 2),
+        else_=3,
+    )
+
+    # LIKE и оператор % обслуживаются GIN-индексом gin_trgm_ops, алиасы —
+    # GIN-индексом по массиву; порог 0.45 перепроверяется на кандидатах.
+    stmt = select(EquipmentModel.id, rank.label("rank")).where(
+        or_(
+            alias_hit,
+            search_name.contains(q),
+            and_(search_name.op("%")(q), similarity >= FUZZY_THRESHOLD),
+        )
+    )
 
+    if not include_inactive:
+        stmt = stmt.where(EquipmentModel.is_active.is_(True))
 
-def search_models(
-    db: Session,
+    return stmt.order_by(rank, similarity.desc(), EquipmentModel.id).limit(limit)
+
+
+async def _search_model_ids(
+    db: AsyncSession,
+    q: str,
+    include_inactive: bool,
+    limit: int,
+) -> list[int]:
+    if CATALOG_SEARCH_BACKEND == "trgm":
+        rows = (await db.execute(_trgm_search_stmt(q, include_inactive, limit))).all()
+        if not rows:
+            return []
+        if rows[0].rank <= 1:
+            return [rows[0].id]
+        return [row.id for row in rows if row.rank == rows[0].rank]
+
+    if not catalog_index.loaded:
+        await catalog_index.rebuild(db)
+
+    return catalog_index.search(q, include_inactive=include_inactive, limit=limit)
+
+
+async def _resolve_model_ids(
+    db: AsyncSession,
+    queries: list[str],
+    include_inactive: bool,
+) -> list[int | None]:
+    if CATALOG_SEARCH_BACKEND == "trgm":
+        lines = (
+            func.unnest(bindparam("queries", queries, type_=ARRAY(EquipmentModel.search_name.type)))
+            .table_valued("q", with_ordinality="ord")
+            .render_derived(name="lines")
+        )
+        best = _trgm_search_stmt(lines.c.q, include_inactive, 1).lateral("best")
+        stmt = select(lines.c.ord, best.c.id).select_from(lines).join(best, true())
+
+        by_ord = {ord_: model_id for ord_, model_id in (await db.execute(stmt)).all()}
+        return [by_ord.get(i) for i in range(1, len(queries) + 1)]
+
+    if not catalog_index.loaded:
+        await catalog_index.rebuild(db)
+
+    resolved: list[int | None] = []
+    for q in queries:
+        model_ids = catalog_index.search(q, include_inactive=include_inactive, limit=1)
+        resolved.append(model_ids[0] if model_ids else None)
+    return resolved
+
+
+async def search_models(
+    db: AsyncSession,
     query: str,
     include_inactive: bool = True,
     limit: int = 5,
@@ -83,40 +142,67 @@ def search_models(
     if not q:
         return []
 
-    stmt = select(EquipmentModel)
+    model_ids = await _search_model_ids(db, q, include_inactive, limit)
+    return await get_models_by_ids(db, model_ids)
 
-    if not include_inactive:
-        stmt = stmt.where(EquipmentModel.is_active.is_(True))
 
-    all_models = list(db.execute(stmt).scalars().all())
+async def find_model_ids_containing(
+    db: AsyncSession,
+    query: str,
+    include_inactive: bool = True,
+) -> list[int]:
+    # Модели, в названии которых есть query, — все, без ранжирования.
+    q = normalize_text(query)
+    if not q:
+        return []
 
-    exact = [m for m in all_models if m.search_name == q]
-    if exact:
-        return exact[:1]
+    if CATALOG_SEARCH_BACKEND == "trgm":
+        # LIKE '%q%' по search_name обслуживает GIN-индекс gin_trgm_ops.
+        stmt = select(EquipmentModel.id).where(EquipmentModel.search_name.contains(q))
+        if not include_inactive:
+            stmt = stmt.where(EquipmentModel.is_active.is_(True))
+        return list((await db.execute(stmt.order_by(EquipmentModel.id))).scalars().all())
 
-    contains = [m for m in all_models if q in m.search_name]
-    if contains:
-        return contains[:limit]
+    if not catalog_index.loaded:
+        await catalog_index.rebuild(db)
 
-    ranked = sorted(
-        all_models,
-        key=lambda m: SequenceMatcher(None, q, m.search_name).ratio(),
-        reverse=True,
-    )
+    return catalog_index.containing(q, include_inactive=include_inactive)
+
+
+async def resolve_item_lines(
+    db: AsyncSession,
+    parsed_items: list[tuple[str, int]],
+    include_inactive: bool = False,
+) -> tuple[list[tuple[EquipmentModel, int]], list[str]]:
+    queries = [normalize_text(raw_name) for raw_name, _ in parsed_items]
+    resolved = await _resolve_model_ids(db, queries, include_inactive)
+
+    matched: list[tuple[str, int, int]] = []
+    not_found: list[str] = []
+
+    for (raw_name, qty), q, model_id in zip(parsed_items, queries, resolved):
+        if not q or model_id is None:
+            not_found.append(raw_name)
+            continue
+        matched.append((raw_name, model_id, qty))
+
+    # Все найденные строки сметы дочитываем одним запросом по первичному ключу.
+    unique_ids = list(dict.fromkeys(model_id for _, model_id, _ in matched))
+    models = {m.id: m for m in await get_models_by_ids(db, unique_ids)}
 
-    result = []
-    for model in ranked:
-        ratio = SequenceMatcher(None, q, model.search_name).ratio()
-        if ratio >= 0.45:
-            result.append(model)
-        if len(result) >= limit:
-            break
+    found: list[tuple[EquipmentModel, int]] = []
+    for raw_name, model_id, qty in matched:
+        model = models.get(model_id)
+        if model is None:
+            not_found.append(raw_name)
+            continue
+        found.append((model, qty))
 
-    return result
+    return found, not_found
 
 
-def update_equipment_model(
-    db: Session,
+async def update_equipment_model(
+    db: AsyncSession,
     model_id: int,
     *,
     name: str | None = None,
@@ -124,25 +210,24 @@ def update_equipment_model(
     daily_rent_price: float | None = None,
     estimated_value: float | None = None,
 ) -> EquipmentModel | None:
-    model = db.get(EquipmentModel, model_id)
+    model = await db.get(EquipmentModel, model_id)
     if not model:
         return None
 
     if name is not None:
         new_search_name = normalize_text(name)
 
-        existing = db.execute(
+        existing = (await db.execute(
             select(EquipmentModel).where(
                 EquipmentModel.search_name == new_search_name,
                 EquipmentModel.id != model_id,
             )
-        ).scalar_one_or_none()
+        )).scalar_one_or_none()
 
         if existing:
             raise ValueError("Модель с таким названием уже существует.")
 
         model.name = name.strip()
-        model.search_name = new_search_name
 
     if category is not None:
         model.category = category.strip()
@@ -153,6 +238,10 @@ def update_equipment_model(
     if estimated_value is not None:
         model.estimated_value = estimated_value
 
-    db.commit()
-    db.refresh(model)
+    await db.commit()
+    await db.refresh(model)
+    catalog_index.upsert(model)
+    if name is not None or daily_rent_price is not None:
+        # Название и цена модели видны в карточках смет с этой моделью.
+        await order_card_cache.forget_model(model_id)
     return model
@@ -0,0 +1,188 @@
+from collections.abc import Iterable
+from datetime import date, timedelta
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import (
+    AVAILABLE_UNIT_STATUS,
+    RELEASED_BOOKING_STATUSES,
+    Booking,
+    EquipmentUnit,
+)
+
+
+PAST_DAYS = 31
+HORIZON_DAYS = 731
+
+
+# Процессная карта занятости: для каждой модели — число забронированных
+# единиц по дням (int32-строка матрицы) и число исправных единиц на складе.
+# Проверка сметы — срез окна дат и сравнение с остатком, без SQL.
+#
+# Свободно = склад - пик броней в окне: считаем, что брони можно
+# перераспределить по единицам (это и делает автоподбор при подтверждении).
+# SQL-проверка в availability_service строже: она смотрит на конкретные
+# единицы, поэтому служит запасным путём, а не эталоном.
+class OccupancyCache:
+    def __init__(self) -> None:
+        self._rows: dict[int, int] = {}
+        self._counts = np.zeros((0, HORIZON_DAYS), dtype=np.int32)
+        self._stock = np.zeros(0, dtype=np.int32)
+        self._origin = date.today() - timedelta(days=PAST_DAYS)
+        self._loaded = False
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    async def rebuild(self, db: AsyncSession) -> None:
+        origin = date.today() - timedelta(days=PAST_DAYS)
+        horizon_end = origin + timedelta(days=HORIZON_DAYS - 1)
+
+        stock_stmt = (
+            select(EquipmentUnit.model_id, func.count())
+            .where(EquipmentUnit.status == AVAILABLE_UNIT_STATUS)
+            .group_by(EquipmentUnit.model_id)
+        )
+        bookings_stmt = (
+            select(EquipmentUnit.model_id, Booking.start_date, Booking.end_date)
+            .join(EquipmentUnit, EquipmentUnit.id == Booking.equipment_unit_id)
+            .where(
+                Booking.status.not_in(RELEASED_BOOKING_STATUSES),
+                Booking.end_date >= origin,
+                Booking.start_date <= horizon_end,
+            )
+        )
+        stock_rows = (await db.execute(stock_stmt)).all()
+        booking_rows = (await db.execute(bookings_stmt)).all()
+
+        model_ids = {model_id for model_id, _ in stock_rows}
+        model_ids.update(model_id for model_id, _, _ in booking_rows)
+        rows = {model_id: row for row, model_id in enumerate(sorted(model_ids))}
+
+        stock = np.zeros(len(rows), dtype=np.int32)
+        for model_id, count in stock_rows:
+            stock[rows[model_id]] = count
+
+        # Разностный массив: +1 в день начала, -1 после дня окончания,
+        # затем cumsum по дням даёт занятость за один проход.
+        diff = np.zeros((len(rows), HORIZON_DAYS + 1), dtype=np.int32)
+        if booking_rows:
+            model_col, start_col, end_col = zip(*booking_rows)
+            row_idx = np.fromiter((rows[m] for m in model_col), dtype=np.intp)
+            start_idx = np.clip(
+                np.fromiter(((d - origin).days for d in start_col), dtype=np.intp),
+                0,
+                HORIZON_DAYS,
+            )
+            end_idx = np.clip(
+                np.fromiter(((d - origin).days + 1 for d in end_col), dtype=np.intp),
+                0,
+                HORIZON_DAYS,
+            )
+            np.add.at(diff, (row_idx, start_idx), 1)
+            np.add.at(diff, (row_idx, end_idx), -1)
+
+        self._rows = rows
+        self._counts = np.cumsum(diff[:, :HORIZON_DAYS], axis=1, dtype=np.int32)
+        self._stock = stock
+        self._origin = origin
+        self._loaded = True
+
+    def _row(self, model_id: int) -> int:
+        row = self._rows.get(model_id)
+        if row is not None:
+            return row
+
+        row = len(self._rows)
+        if row >= self._counts.shape[0]:
+            capacity = max(8, self._counts.shape[0] * 2)
+            counts = np.zeros((capacity, HORIZON_DAYS), dtype=np.int32)
+            counts[:row] = self._counts[:row]
+            stock = np.zeros(capacity, dtype=np.int32)
+            stock[:row] = self._stock[:row]
+            self._counts = counts
+            self._stock = stock
+
+        self._rows[model_id] = row
+        return row
+
+    def _window(self, start_date: date, end_date: date) -> slice | None:
+        start = (start_date - self._origin).days
+        stop = (end_date - self._origin).days + 1
+        if start < 0 or stop > HORIZON_DAYS or start >= stop:
+            return None
+        return slice(start, stop)
+
+    def _clipped_window(self, start_date: date, end_date: date) -> slice | None:
+        start = max((start_date - self._origin).days, 0)
+        stop = min((end_date - self._origin).days + 1, HORIZON_DAYS)
+        if start >= stop:
+            return None
+        return slice(start, stop)
+
+    def booking_added(self, model_id: int, start_date: date, end_date: date) -> None:
+        self._shift(model_id, start_date, end_date, 1)
+
+    def booking_released(self, model_id: int, start_date: date, end_date: date) -> None:
+        self._shift(model_id, start_date, end_date, -1)
+
+    def _shift(self, model_id: int, start_date: date, end_date: date, delta: int) -> None:
+        if not self._loaded:
+            return
+        window = self._clipped_window(start_date, end_date)
+        if window is None:
+            return
+        row = self._row(model_id)
+        self._counts[row, window] += delta
+
+    def stock_changed(self, model_id: int, delta: int) -> None:
+        if not self._loaded:
+            return
+        row = self._row(model_id)
+        self._stock[row] += delta
+
+    def shortages(
+        self,
+        requested: Iterable[tuple[int, int]],
+        start_date: date,
+        end_date: date,
+    ) -> list[tuple[int, int, int]] | None:
+        # None — окно вне горизонта или кэш не загружен: спросите SQL.
+        if not self._loaded:
+            return None
+        window = self._window(start_date, end_date)
+        if window is None:
+            return None
+
+        wanted: dict[int, int] = {}
+        for model_id, qty in requested:
+            wanted[model_id] = wanted.get(model_id, 0) + qty
+        if not wanted:
+            return []
+
+        model_ids = np.fromiter(wanted, dtype=np.int64, count=len(wanted))
+        qty = np.fromiter(wanted.values(), dtype=np.int32, count=len(wanted))
+        rows = np.fromiter(
+            (self._rows.get(model_id, -1) for model_id in wanted),
+            dtype=np.intp,
+            count=len(wanted),
+        )
+
+        known = rows >= 0
+        free = np.zeros(len(wanted), dtype=np.int32)
+        if known.any():
+            known_rows = rows[known]
+            peak = self._counts[known_rows, window].max(axis=1)
+            free[known] = np.maximum(self._stock[known_rows] - peak, 0)
+
+        short = np.flatnonzero(free < qty)
+        return [
+            (int(model_ids[i]), int(qty[i]), int(free[i]))
+            for i in short
+        ]
+
+
+occupancy_cache = OccupancyCache()
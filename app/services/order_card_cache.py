@@ -0,0 +1,154 @@
+import logging
+import time
+from collections import OrderedDict
+from collections.abc import Iterable
+from datetime import datetime
+
+import orjson
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+
+logger = logging.getLogger(__name__)
+
+# Карточка без строки статуса: (всё до статуса, всё после).
+CardParts = tuple[str, str]
+
+CARD_CACHE_SIZE = 512
+# Локальная копия не знает о правках моделей в других процессах,
+# поэтому живёт недолго; в Redis карточки лежат неделю.
+CARD_MEMORY_TTL = 300.0
+CARD_REDIS_TTL = 7 * 24 * 3600
+
+
+# Кэш отрисованных карточек сохранённых смет по ключу (order_id, updated_at):
+# любая запись в orders двигает updated_at, и старая карточка просто
+# перестаёт совпадать. Статус в карточку не входит и подставляется при
+# выводе, поэтому после смены одного статуса запись переносится на новую
+# версию без перерисовки. Позиции ссылаются на модели, а правка модели
+# orders не трогает — такие карточки сбрасываются через forget_model.
+class OrderCardCache:
+    def __init__(self, maxsize: int = CARD_CACHE_SIZE) -> None:
+        self.maxsize = maxsize
+        self.redis: Redis | None = None
+        self._entries: OrderedDict[int, tuple[str, float, CardParts, frozenset[int]]] = (
+            OrderedDict()
+        )
+
+    def configure(self, redis: Redis | None) -> None:
+        self.redis = redis
+
+    @staticmethod
+    def _version(updated_at: datetime) -> str:
+        return updated_at.isoformat()
+
+    @staticmethod
+    def _redis_key(order_id: int, version: str) -> str:
+        return f"order_card:{order_id}:{version}"
+
+    @staticmethod
+    def _model_key(model_id: int) -> str:
+        return f"order_card:model:{model_id}"
+
+    def _remember(
+        self,
+        order_id: int,
+        version: str,
+        parts: CardParts,
+        model_ids: frozenset[int],
+    ) -> None:
+        self._entries[order_id] = (version, time.monotonic(), parts, model_ids)
+        self._entries.move_to_end(order_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    async def _lookup(
+        self,
+        order_id: int,
+        version: str,
+    ) -> tuple[CardParts, frozenset[int]] | None:
+        entry = self._entries.get(order_id)
+        if entry is not None:
+            cached_version, stored_at, parts, model_ids = entry
+            if cached_version == version and time.monotonic() - stored_at < CARD_MEMORY_TTL:
+                self._entries.move_to_end(order_id)
+                return parts, model_ids
+            del self._entries[order_id]
+
+        if self.redis is None:
+            return None
+        try:
+            raw = await self.redis.get(self._redis_key(order_id, version))
+        except RedisError:
+            logger.warning("order card cache: redis get failed", exc_info=True)
+            return None
+        if raw is None:
+            return None
+
+        head, tail, model_ids = orjson.loads(raw)
+        parts, model_ids = (head, tail), frozenset(model_ids)
+        self._remember(order_id, version, parts, model_ids)
+        return parts, model_ids
+
+    async def get(self, order_id: int, updated_at: datetime) -> CardParts | None:
+        found = await self._lookup(order_id, self._version(updated_at))
+        return found[0] if found is not None else None
+
+    async def put(
+        self,
+        order_id: int,
+        updated_at: datetime,
+        parts: CardParts,
+        model_ids: Iterable[int],
+    ) -> None:
+        version = self._version(updated_at)
+        model_ids = frozenset(model_ids)
+        self._remember(order_id, version, parts, model_ids)
+
+        if self.redis is None:
+            return
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.set(
+                    self._redis_key(order_id, version),
+                    orjson.dumps([*parts, sorted(model_ids)]),
+                    ex=CARD_REDIS_TTL,
+                )
+                for model_id in model_ids:
+                    model_key = self._model_key(model_id)
+                    pipe.sadd(model_key, self._redis_key(order_id, version))
+                    pipe.expire(model_key, CARD_REDIS_TTL)
+                await pipe.execute()
+        except RedisError:
+            logger.warning("order card cache: redis set failed", exc_info=True)
+
+    async def carry(
+        self,
+        order_id: int,
+        previous: datetime,
+        updated_at: datetime,
+    ) -> None:
+        # Запись в orders не меняла содержимое карточки (только статус).
+        found = await self._lookup(order_id, self._version(previous))
+        if found is not None:
+            await self.put(order_id, updated_at, *found)
+
+    async def forget_model(self, model_id: int) -> None:
+        for order_id in [
+            order_id
+            for order_id, (_, _, _, model_ids) in self._entries.items()
+            if model_id in model_ids
+        ]:
+            del self._entries[order_id]
+
+        if self.redis is None:
+            return
+        model_key = self._model_key(model_id)
+        try:
+            keys = await self.redis.smembers(model_key)
+            await self.redis.delete(model_key, *keys)
+        except RedisError:
+            logger.warning("order card cache: redis invalidation failed", exc_info=True)
+
+
+order_card_cache = OrderCardCache()
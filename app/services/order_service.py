@@ -1,23 +1,27 @@
 from datetime import datetime
 from decimal import Decimal
 
-from sqlalchemy import func, select
-from sqlalchemy.orm import Session, selectinload
-
-from app.db.models import Order, OrderItem
+from sqlalchemy import Row, delete, func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+
+from app.db.models import EquipmentModel, Order, OrderItem
+from app.services.assignment_service import (
+    BookingChange,
+    apply_booking_changes,
+    assign_order_units,
+    drop_order_bookings,
+    release_order_bookings,
+    trim_order_bookings,
+)
+from app.services.order_card_cache import order_card_cache
 
 
 ORDER_STATUSES = {"draft", "confirmed", "done", "cancelled"}
 
 
-def get_next_order_number(db: Session) -> int:
-    stmt = select(func.max(Order.order_number))
-    last_number = db.execute(stmt).scalar_one_or_none()
-    return 1 if last_number is None else last_number + 1
-
-
-def create_order(
-    db: Session,
+async def create_order(
+    db: AsyncSession,
     project_name: str,
     client_id: int,
     start_at: datetime,
@@ -26,12 +30,13 @@ def create_order(
     discount_percent: Decimal | float = 0,
     subrental_total: Decimal | float = 0,
     comment: str | None = None,
+    items_payload: list[dict] | None = None,
 ) -> Order:
     discount_percent = Decimal(str(discount_percent))
     subrental_total = Decimal(str(subrental_total))
 
+    # order_number выдаёт sequence прямо в INSERT ... RETURNING.
     order = Order(
-        order_number=get_next_order_number(db),
         project_name=project_name.strip(),
         client_id=client_id,
         start_date=start_at.date(),
@@ -52,64 +57,88 @@ def create_order(
         debt_total=Decimal("0"),
     )
     db.add(order)
-    db.commit()
-    db.refresh(order)
-    return order
 
+    # Заказ, позиции и итоги — одной транзакцией, без промежуточных commit.
+    try:
+        await db.flush()
+        if items_payload:
+            db.add_all(
+                OrderItem(
+                    order_id=order.id,
+                    model_id=payload["model_id"],
+                    qty=payload["qty"],
+                    unit_price_client=payload["unit_price_client"],
+                    is_subrental=False,
+                    subrental_cost=0,
+                )
+                for payload in items_payload
+            )
+            await db.flush()
+            await recalc_order_totals(db, order.id, commit=False)
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
 
-def get_last_order(db: Session) -> Order | None:
-    stmt = (
-        select(Order)
-        .options(
-            selectinload(Order.client),
-            selectinload(Order.items).selectinload(OrderItem.model),
-        )
-        .order_by(Order.id.desc())
-        .limit(1)
-    )
-    return db.execute(stmt).scalar_one_or_none()
+    return await get_order_by_id(db, order.id)
 
 
-def get_order_by_number(db: Session, order_number: int) -> Order | None:
-    stmt = (
+def _order_aggregate_stmt():
+    # Заказ, клиент и позиции с моделями одним SELECT через JOIN.
+    return (
         select(Order)
         .options(
-            selectinload(Order.client),
-            selectinload(Order.items).selectinload(OrderItem.model),
+            joinedload(Order.client),
+            joinedload(Order.items).joinedload(OrderItem.model),
         )
-        .where(Order.order_number == order_number)
+        .execution_options(populate_existing=True)
     )
-    return db.execute(stmt).scalar_one_or_none()
 
 
-def get_order_by_id(db: Session, order_id: int) -> Order | None:
-    stmt = (
-        select(Order)
-        .options(
-            selectinload(Order.client),
-            selectinload(Order.items).selectinload(OrderItem.model),
-        )
-        .where(Order.id == order_id)
-    )
-    return db.execute(stmt).scalar_one_or_none()
+async def _load_order(db: AsyncSession, stmt) -> Order | None:
+    return (await db.execute(stmt)).unique().scalar_one_or_none()
 
 
-def update_order_status(db: Session, order_id: int, new_status: str) -> Order | None:
-    if new_status not in ORDER_STATUSES:
-        raise ValueError("Недопустимый статус")
+async def get_last_order(db: AsyncSession) -> Order | None:
+    stmt = _order_aggregate_stmt().order_by(Order.id.desc()).limit(1)
+    return await _load_order(db, stmt)
 
-    order = db.get(Order, order_id)
-    if not order:
-        return None
 
-    order.status = new_status
-    db.commit()
+async def get_order_by_number(db: AsyncSession, order_number: int) -> Order | None:
+    stmt = _order_aggregate_stmt().where(Order.order_number == order_number)
+    return await _load_order(db, stmt)
 
-    return get_order_by_id(db, order_id)
 
+async def get_order_by_id(db: AsyncSession, order_id: int) -> Order | None:
+    stmt = _order_aggregate_stmt().where(Order.id == order_id)
+    return await _load_order(db, stmt)
 
-def add_order_item(
-    db: Session,
+
+# Версия заказа без агрегата: (id, updated_at, status) — по ней карточка
+# берётся из order_card_cache, и позиции с моделями грузятся только при промахе.
+_ORDER_HEAD = (Order.id, Order.updated_at, Order.status)
+
+
+async def _load_order_head(db: AsyncSession, stmt) -> Row | None:
+    return (await db.execute(stmt)).one_or_none()
+
+
+async def get_last_order_head(db: AsyncSession) -> Row | None:
+    stmt = select(*_ORDER_HEAD).order_by(Order.id.desc()).limit(1)
+    return await _load_order_head(db, stmt)
+
+
+async def get_order_head_by_number(db: AsyncSession, order_number: int) -> Row | None:
+    stmt = select(*_ORDER_HEAD).where(Order.order_number == order_number)
+    return await _load_order_head(db, stmt)
+
+
+async def update_order_status(db: AsyncSession, order_id: int, new_status: str) -> Row | None:
+    return await OrderUnitOfWork(db, order_id).set_status(new_status).commit_head()
+
+
+async def add_order_item(
+    db: AsyncSession,
     order_id: int,
     model_id: int,
     qty: int,
@@ -128,148 +157,406 @@ def add_order_item(
         comment=comment,
     )
     db.add(item)
-    db.commit()
-    db.refresh(item)
+    await db.commit()
+    await db.refresh(item)
     return item
 
 
-def get_order_items(db: Session, order_id: int) -> list[OrderItem]:
+async def get_order_items(db: AsyncSession, order_id: int) -> list[OrderItem]:
     stmt = select(OrderItem).where(OrderItem.order_id == order_id)
-    return list(db.execute(stmt).scalars().all())
-
+    return list((await db.execute(stmt)).scalars().all())
 
-def recalc_order_totals(db: Session, order_id: int) -> None:
-    order = db.get(Order, order_id)
-    if not order:
-        return
 
-    items = get_order_items(db, order_id)
+def _order_totals_values(
+    order_id: int,
+    discount_percent=Order.discount_percent,
+    priced_items=None,
+) -> dict:
+    # priced_items — необязательный CTE c колонками qty/unit_price_client
+    # (UPDATE order_items ... RETURNING): изменения CTE не видны остальной
+    # части того же запроса, поэтому сумму тогда считаем по его RETURNING.
+    if priced_items is None:
+        items_total = (
+            select(
+                func.coalesce(
+                    func.sum(OrderItem.unit_price_client * OrderItem.qty), 0
+                ).label("subtotal")
+            )
+            .where(OrderItem.order_id == order_id)
+            .subquery("items_total")
+        )
+    else:
+        items_total = select(
+            func.coalesce(
+                func.sum(priced_items.c.unit_price_client * priced_items.c.qty), 0
+            ).label("subtotal")
+        ).subquery("items_total")
+
+    subtotal = items_total.c.subtotal
+    client_total = func.round(subtotal * (100 - discount_percent) / 100, 2)
+
+    return {
+        "subtotal": subtotal,
+        "client_total": client_total,
+        "profit_total": client_total - Order.subrental_total,
+        "debt_total": client_total - Order.paid_total,
+    }
+
+
+async def recalc_order_totals(
+    db: AsyncSession,
+    order_id: int,
+    *,
+    commit: bool = True,
+) -> None:
+    # UPDATE orders ... FROM (SELECT sum(...) FROM order_items): суммы
+    # считаются в numeric на стороне БД, без чтения позиций в Python.
+    stmt = (
+        update(Order)
+        .where(Order.id == order_id)
+        .values(**_order_totals_values(order_id))
+        .execution_options(synchronize_session=False)
+    )
+    await db.execute(stmt)
+
+    if commit:
+        await db.commit()
+
+
+class OrderUnitOfWork:
+    # Копит изменения сохранённой сметы и применяет их одной транзакцией:
+    # позиции -> один UPDATE orders вместе с перерасчётом цен и итогов ->
+    # брони единиц по статусу заказа.
+    #
+    #     order = await (
+    #         OrderUnitOfWork(db, order_id)
+    #         .set_discount(10)
+    #         .set_comment("...")
+    #         .commit()
+    #     )
+    def __init__(self, db: AsyncSession, order_id: int) -> None:
+        self.db = db
+        self.order_id = order_id
+        self._values: dict = {}
+        self._items_payload: list[dict] | None = None
+        self._reprice_shifts: int | None = None
+
+    def set_project_name(self, project_name: str) -> "OrderUnitOfWork":
+        self._values["project_name"] = project_name.strip()
+        return self
+
+    def set_client(self, client_id: int) -> "OrderUnitOfWork":
+        self._values["client_id"] = client_id
+        return self
+
+    def set_comment(self, comment: str) -> "OrderUnitOfWork":
+        self._values["comment"] = comment
+        return self
+
+    def set_status(self, status: str) -> "OrderUnitOfWork":
+        if status not in ORDER_STATUSES:
+            raise ValueError("Недопустимый статус")
+        self._values["status"] = status
+        return self
+
+    def set_discount(self, discount_percent: Decimal | float) -> "OrderUnitOfWork":
+        self._values["discount_percent"] = Decimal(str(discount_percent))
+        return self
+
+    def set_datetimes(
+        self,
+        start_at: datetime,
+        end_at: datetime,
+        shifts: int,
+    ) -> "OrderUnitOfWork":
+        self._values.update(
+            start_at=start_at,
+            end_at=end_at,
+            start_date=start_at.date(),
+            end_date=end_at.date(),
+            shifts=shifts,
+        )
+        self._reprice_shifts = shifts
+        return self
+
+    def replace_items(self, items_payload: list[dict]) -> "OrderUnitOfWork":
+        self._items_payload = list(items_payload)
+        return self
+
+    async def _sync_bookings(self, status: str | None) -> list[BookingChange]:
+        # Подтверждённый заказ держит брони на конкретные единицы;
+        # отменённый/завершённый их освобождает, черновик — не бронирует.
+        db = self.db
+        order_id = self.order_id
+        status_changed = "status" in self._values
+
+        if status == "confirmed":
+            if not (
+                status_changed
+                or self._items_payload is not None
+                or self._reprice_shifts is not None
+            ):
+                return []
+            changes: list[BookingChange] = []
+            if self._reprice_shifts is not None:
+                changes += await drop_order_bookings(db, order_id)
+            elif self._items_payload is not None:
+                changes += await trim_order_bookings(db, order_id)
+            changes += await assign_order_units(db, order_id)
+            return changes
+
+        if status_changed:
+            released = "returned" if status == "done" else "cancelled"
+            return await release_order_bookings(db, order_id, released)
+
+        return []
+
+    @property
+    def _touches_totals(self) -> bool:
+        return (
+            self._items_payload is not None
+            or self._reprice_shifts is not None
+            or "discount_percent" in self._values
+        )
 
-    subtotal = sum(float(item.unit_price_client) * item.qty for item in items)
-    discount_percent = float(order.discount_percent or 0)
-    discount_amount = subtotal * discount_percent / 100
-    client_total = subtotal - discount_amount
-    subrental_total = float(order.subrental_total or 0)
+    async def commit(self) -> Order | None:
+        head = await self.commit_head()
+        if head is None:
+            return None
+        return await get_order_by_id(self.db, self.order_id)
+
+    async def commit_head(self) -> Row | None:
+        # Как commit, но возвращает только (id, updated_at, status),
+        # без повторной загрузки агрегата.
+        db = self.db
+        order_id = self.order_id
+
+        status = self._values.get("status")
+        # Карточка заказа зависит от всего, кроме статуса.
+        status_only = (
+            self._values.keys() == {"status"}
+            and self._items_payload is None
+            and self._reprice_shifts is None
+        )
+        previous_version = None
+        booking_changes: list[BookingChange] = []
+
+        try:
+            if (
+                self._items_payload is not None
+                or self._reprice_shifts is not None
+                or status is not None
+            ):
+                # Блокируем заказ до изменения позиций и броней: заодно
+                # проверяем, что он существует, и сериализуем параллельные правки.
+                locked = (
+                    await db.execute(
+                        select(Order.status, Order.updated_at)
+                        .where(Order.id == order_id)
+                        .with_for_update()
+                    )
+                ).one_or_none()
+                if locked is None:
+                    await db.rollback()
+                    return None
+                current_status, previous_version = locked
+                if status is None:
+                    status = current_status
+
+            if self._items_payload is not None:
+                booking_changes += await _replace_items(db, order_id, self._items_payload)
+
+            priced_items = None
+            if self._reprice_shifts is not None:
+                priced_items = _repriced_items_cte(order_id, self._reprice_shifts)
+
+            values = dict(self._values)
+            if self._touches_totals:
+                values.update(
+                    _order_totals_values(
+                        order_id,
+                        values.get("discount_percent", Order.discount_percent),
+                        priced_items,
+                    )
+                )
+
+            if values:
+                stmt = (
+                    update(Order)
+                    .where(Order.id == order_id)
+                    .values(**values)
+                    .returning(*_ORDER_HEAD)
+                    .execution_options(synchronize_session=False)
+                )
+            else:
+                stmt = select(*_ORDER_HEAD).where(Order.id == order_id)
+            head = (await db.execute(stmt)).one_or_none()
+            if head is None:
+                await db.rollback()
+                return None
+
+            booking_changes += await self._sync_bookings(status)
+
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+
+        apply_booking_changes(booking_changes)
+        if status_only and previous_version is not None:
+            await order_card_cache.carry(order_id, previous_version, head.updated_at)
+
+        self._values.clear()
+        self._items_payload = None
+        self._reprice_shifts = None
+        return head
+
+
+def _merge_items_payload(items_payload: list[dict]) -> dict[int, dict]:
+    # Повторы одной модели в списке складываем в одну строку.
+    merged: dict[int, dict] = {}
+    for payload in items_payload:
+        model_id = int(payload["model_id"])
+        price = Decimal(str(payload["unit_price_client"])).quantize(Decimal("0.01"))
+        line = merged.get(model_id)
+        if line is None:
+            merged[model_id] = {"qty": int(payload["qty"]), "unit_price_client": price}
+        else:
+            line["qty"] += int(payload["qty"])
+            line["unit_price_client"] = price
+    return merged
+
+
+async def _replace_items(
+    db: AsyncSession,
+    order_id: int,
+    items_payload: list[dict],
+) -> list[BookingChange]:
+    # Применяем только разницу с текущими позициями: неизменённые строки
+    # (и их брони) не трогаем, остальное — тремя пакетными запросами.
+    requested = _merge_items_payload(items_payload)
 
-    order.subtotal = subtotal
-    order.client_total = client_total
-    order.profit_total = client_total - subrental_total
-    order.debt_total = client_total - float(order.paid_total)
+    stmt = (
+        select(OrderItem.id, OrderItem.model_id, OrderItem.qty, OrderItem.unit_price_client)
+        .where(OrderItem.order_id == order_id)
+        .order_by(OrderItem.id)
+    )
+    current = (await db.execute(stmt)).all()
+
+    to_delete: list[int] = []
+    to_update: list[dict] = []
+    kept: set[int] = set()
+
+    for item_id, model_id, qty, unit_price_client in current:
+        line = requested.get(model_id)
+        if line is None or model_id in kept:
+            to_delete.append(item_id)
+            continue
+
+        kept.add(model_id)
+        if qty != line["qty"] or unit_price_client != line["unit_price_client"]:
+            to_update.append(
+                {
+                    "id": item_id,
+                    "qty": line["qty"],
+                    "unit_price_client": line["unit_price_client"],
+                }
+            )
 
-    db.commit()
-    db.refresh(order)
+    to_insert = [
+        {
+            "order_id": order_id,
+            "model_id": model_id,
+            "qty": line["qty"],
+            "unit_price_client": line["unit_price_client"],
+            "is_subrental": False,
+            "subrental_cost": 0,
+        }
+        for model_id, line in requested.items()
+        if model_id not in kept
+    ]
+
+    booking_changes: list[BookingChange] = []
+    if to_delete:
+        # Брони удалились бы каскадом, но кэш занятости должен о них узнать.
+        booking_changes = await drop_order_bookings(db, order_id, to_delete)
+        await db.execute(
+            delete(OrderItem)
+            .where(OrderItem.id.in_(to_delete))
+            .execution_options(synchronize_session=False)
+        )
+    if to_update:
+        await db.execute(update(OrderItem), to_update)
+    if to_insert:
+        await db.execute(insert(OrderItem), to_insert)
+
+    return booking_changes
+
+
+def _repriced_items_cte(order_id: int, shifts: int):
+    # UPDATE order_items SET unit_price_client = m.daily_rent_price * :shifts
+    # FROM equipment_models m ... RETURNING — в составе UPDATE orders.
+    return (
+        update(OrderItem)
+        .where(
+            OrderItem.order_id == order_id,
+            OrderItem.model_id == EquipmentModel.id,
+        )
+        .values(unit_price_client=EquipmentModel.daily_rent_price * shifts)
+        .returning(OrderItem.qty, OrderItem.unit_price_client)
+        .cte("repriced_items")
+    )
 
 
-def update_order_project_name(
-    db: Session,
+async def update_order_project_name(
+    db: AsyncSession,
     order_id: int,
     project_name: str,
 ) -> Order | None:
-    order = db.get(Order, order_id)
-    if not order:
-        return None
+    return await OrderUnitOfWork(db, order_id).set_project_name(project_name).commit()
 
-    order.project_name = project_name.strip()
-    db.commit()
-    return get_order_by_id(db, order_id)
 
-
-def update_order_client(
-    db: Session,
+async def update_order_client(
+    db: AsyncSession,
     order_id: int,
     client_id: int,
 ) -> Order | None:
-    order = db.get(Order, order_id)
-    if not order:
-        return None
-
-    order.client_id = client_id
-    db.commit()
-    return get_order_by_id(db, order_id)
+    return await OrderUnitOfWork(db, order_id).set_client(client_id).commit()
 
 
-def update_order_comment(
-    db: Session,
+async def update_order_comment(
+    db: AsyncSession,
     order_id: int,
     comment: str,
 ) -> Order | None:
-    order = db.get(Order, order_id)
-    if not order:
-        return None
+    return await OrderUnitOfWork(db, order_id).set_comment(comment).commit()
 
-    order.comment = comment
-    db.commit()
-    return get_order_by_id(db, order_id)
 
-
-def update_order_discount(
-    db: Session,
+async def update_order_discount(
+    db: AsyncSession,
     order_id: int,
     discount_percent: float,
 ) -> Order | None:
-    order = db.get(Order, order_id)
-    if not order:
-        return None
-
-    order.discount_percent = discount_percent
-    db.commit()
-    recalc_order_totals(db, order_id)
-    return get_order_by_id(db, order_id)
+    return await OrderUnitOfWork(db, order_id).set_discount(discount_percent).commit()
 
 
-def update_order_datetimes(
-    db: Session,
+async def update_order_datetimes(
+    db: AsyncSession,
     order_id: int,
     start_at: datetime,
     end_at: datetime,
     shifts: int,
 ) -> Order | None:
-    order = get_order_by_id(db, order_id)
-    if not order:
-        return None
-
-    order.start_at = start_at
-    order.end_at = end_at
-    order.start_date = start_at.date()
-    order.end_date = end_at.date()
-    order.shifts = shifts
-
-    for item in order.items:
-        if item.model:
-            item.unit_price_client = float(item.model.daily_rent_price) * shifts
-
-    db.commit()
-    recalc_order_totals(db, order_id)
-    return get_order_by_id(db, order_id)
+    return await (
+        OrderUnitOfWork(db, order_id)
+        .set_datetimes(start_at, end_at, shifts)
+        .commit()
+    )
 
 
-def replace_order_items(
-    db: Session,
+async def replace_order_items(
+    db: AsyncSession,
     order_id: int,
     items_payload: list[dict],
 ) -> Order | None:
-    order = db.get(Order, order_id)
-    if not order:
-        return None
-
-    existing_items = get_order_items(db, order_id)
-    for item in existing_items:
-        db.delete(item)
-
-    db.flush()
-
-    for payload in items_payload:
-        db.add(
-            OrderItem(
-                order_id=order_id,
-                model_id=payload["model_id"],
-                qty=payload["qty"],
-                unit_price_client=payload["unit_price_client"],
-                is_subrental=False,
-                subrental_cost=0,
-            )
-        )
-
-    db.commit()
-    recalc_order_totals(db, order_id)
-    return get_order_by_id(db, order_id)
+    return await OrderUnitOfWork(db, order_id).replace_items(items_payload).commit()
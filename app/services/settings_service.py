@@ -0,0 +1,20 @@
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import AppSetting
+
+
+async def get_setting(db: AsyncSession, key: str) -> str | None:
+    stmt = select(AppSetting.value).where(AppSetting.key == key)
+    return (await db.execute(stmt)).scalar_one_or_none()
+
+
+async def set_setting(db: AsyncSession, key: str, value: str) -> None:
+    stmt = insert(AppSetting).values(key=key, value=value)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[AppSetting.key],
+        set_={"value": stmt.excluded.value, "updated_at": func.now()},
+    )
+    await db.execute(stmt)
+    await db.commit()
@@ -0,0 +1,59 @@
+from bisect import bisect_left, insort
+from collections.abc import Iterable
+from heapq import nsmallest
+
+
+# Зазор, который считаем «свободно надолго»: простаивающая единица
+# получает именно его и проигрывает единицам с плотным расписанием.
+OPEN_GAP_DAYS = 90
+
+# Интервалы — пары порядковых дней (date.toordinal()), концы включительно.
+Interval = tuple[int, int]
+
+
+def _fit_gap(intervals: list[Interval], start: int, end: int) -> int | None:
+    # intervals отсортированы и не пересекаются (ограничение в БД),
+    # поэтому соседей нового интервала находит один bisect.
+    i = bisect_left(intervals, (start, start))
+    if i > 0 and intervals[i - 1][1] >= start:
+        return None
+    if i < len(intervals) and intervals[i][0] <= end:
+        return None
+
+    gap_before = start - intervals[i - 1][1] - 1 if i > 0 else OPEN_GAP_DAYS
+    gap_after = intervals[i][0] - end - 1 if i < len(intervals) else OPEN_GAP_DAYS
+    return min(gap_before, gap_after, OPEN_GAP_DAYS)
+
+
+def allocate_units(
+    requests: Iterable[tuple[object, int, int, int, int]],
+    fleet: dict[int, dict[int, list[Interval]]],
+) -> tuple[dict[object, list[int]], list[tuple[object, int, int]]]:
+    # requests: (key, model_id, qty, start, end);
+    # fleet: model_id -> {unit_id: отсортированные занятые интервалы}.
+    # Best-fit: каждую бронь кладём в самый узкий подходящий просвет,
+    # чтобы длинные свободные окна и простаивающие единицы оставались целыми.
+    # Возвращает (key -> unit_ids, [(key, qty, сколько нашлось)]).
+    # fleet изменяется: назначенные интервалы добавляются в расписания.
+    ordered = sorted(requests, key=lambda r: (r[3], r[3] - r[4]))
+
+    assigned: dict[object, list[int]] = {}
+    shortages: list[tuple[object, int, int]] = []
+
+    for key, model_id, qty, start, end in ordered:
+        units = fleet.get(model_id, {})
+        scored = []
+        for unit_id, intervals in units.items():
+            gap = _fit_gap(intervals, start, end)
+            if gap is not None:
+                scored.append((gap, unit_id))
+
+        chosen = [unit_id for _, unit_id in nsmallest(qty, scored)]
+        for unit_id in chosen:
+            insort(units[unit_id], (start, end))
+
+        assigned[key] = chosen
+        if len(chosen) < qty:
+            shortages.append((key, qty, len(chosen)))
+
+    return assigned, shortages
@@ -1,8 +1,21 @@
-from sqlalchemy import select
-from sqlalchemy.orm import Session, selectinload
-
-from app.db.models import EquipmentModel, EquipmentUnit
-from app.services.inventory_service import normalize_text, search_models
+from sqlalchemy import func, or_, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from app.db.models import (
+    AVAILABLE_UNIT_STATUS,
+    ArticleCounter,
+    EquipmentModel,
+    EquipmentUnit,
+)
+from app.services.inventory_service import (
+    find_model_ids_containing,
+    normalize_text,
+    search_models,
+)
+from app.services.occupancy_cache import occupancy_cache
+from app.utils.text import split_article_number
 
 
 CATEGORY_PREFIXES = {
@@ -32,51 +45,79 @@ def normalize_article_number(value: str) -> str:
     return value.strip().upper()
 
 
-def article_exists(db: Session, article_number: str) -> bool:
+async def article_exists(db: AsyncSession, article_number: str) -> bool:
     normalized = normalize_article_number(article_number)
     stmt = select(EquipmentUnit.id).where(EquipmentUnit.article_number == normalized)
-    return db.execute(stmt).scalar_one_or_none() is not None
+    return (await db.execute(stmt)).scalar_one_or_none() is not None
 
 
-def generate_next_article(db: Session, category: str) -> str:
+async def generate_next_article(db: AsyncSession, category: str) -> str:
+    # Только подсказка для превью: номер не резервируется.
     prefix = get_category_prefix(category)
 
-    stmt = select(EquipmentUnit.article_number).where(
-        EquipmentUnit.article_number.like(f"{prefix}%")
-    )
-    rows = db.execute(stmt).scalars().all()
+    stmt = select(ArticleCounter.last_value).where(ArticleCounter.prefix == prefix)
+    last_value = (await db.execute(stmt)).scalar_one_or_none() or 0
+    return f"{prefix}{last_value + 1:03d}"
+
 
-    max_num = 0
-    for article in rows:
-        if not article:
-            continue
-        digits = "".join(ch for ch in article if ch.isdigit())
-        if digits:
-            max_num = max(max_num, int(digits))
+async def allocate_article(db: AsyncSession, category: str) -> str:
+    prefix = get_category_prefix(category)
 
-    next_num = max_num + 1
+    stmt = (
+        insert(ArticleCounter)
+        .values(prefix=prefix, last_value=1)
+        .on_conflict_do_update(
+            index_elements=[ArticleCounter.prefix],
+            set_={"last_value": ArticleCounter.last_value + 1},
+        )
+        .returning(ArticleCounter.last_value)
+    )
+    next_num = (await db.execute(stmt)).scalar_one()
     return f"{prefix}{next_num:03d}"
 
 
-def create_unit(
-    db: Session,
+async def bump_article_counter(db: AsyncSession, article_number: str) -> None:
+    parts = split_article_number(article_number)
+    if parts is None:
+        return
+
+    prefix, number = parts
+    stmt = insert(ArticleCounter).values(prefix=prefix, last_value=number)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ArticleCounter.prefix],
+        set_={"last_value": func.greatest(ArticleCounter.last_value, stmt.excluded.last_value)},
+    )
+    await db.execute(stmt)
+
+
+async def create_unit(
+    db: AsyncSession,
     model_id: int,
     purchase_price: float,
     defects: str | None = None,
     article_number: str | None = None,
     status: str = "ok",
 ) -> EquipmentUnit:
-    model = db.get(EquipmentModel, model_id)
+    model = await db.get(EquipmentModel, model_id)
     if not model:
         raise ValueError("Модель не найдена")
 
     if status not in {"ok", "repair", "archived"}:
         raise ValueError("Недопустимый статус артикла")
 
-    article = normalize_article_number(article_number) if article_number else generate_next_article(db, model.category)
-
-    if article_exists(db, article):
-        raise ValueError("Такой артикул уже существует")
+    if article_number:
+        article = normalize_article_number(article_number)
+        await bump_article_counter(db, article)
+        if await article_exists(db, article):
+            await db.rollback()
+            raise ValueError("Такой артикул уже существует")
+    else:
+        # Счётчик может отставать от уже занятых номеров (старые данные,
+        # ручной ввод) — такие номера пропускаем, а не падаем на каждом
+        # повторе: откат вернул бы счётчик на тот же занятый номер.
+        article = await allocate_article(db, model.category)
+        while await article_exists(db, article):
+            article = await allocate_article(db, model.category)
 
     unit = EquipmentUnit(
         model_id=model.id,
@@ -93,67 +134,75 @@ def create_unit(
         comment=None,
     )
     db.add(unit)
-    db.commit()
-    db.refresh(unit)
-    return get_unit_by_id(db, unit.id)
+    await db.commit()
+    await db.refresh(unit)
+
+    if unit.status == AVAILABLE_UNIT_STATUS:
+        occupancy_cache.stock_changed(unit.model_id, 1)
 
+    return await get_unit_by_id(db, unit.id)
 
-def get_unit_by_id(db: Session, unit_id: int) -> EquipmentUnit | None:
+
+async def get_unit_by_id(db: AsyncSession, unit_id: int) -> EquipmentUnit | None:
     stmt = (
         select(EquipmentUnit)
         .options(selectinload(EquipmentUnit.model))
         .where(EquipmentUnit.id == unit_id)
     )
-    return db.execute(stmt).scalar_one_or_none()
+    return (await db.execute(stmt)).scalar_one_or_none()
+
+
+async def _find_units(
+    db: AsyncSession,
+    *criteria,
+    order_by=None,
+    limit: int = 10,
+) -> list[EquipmentUnit]:
+    stmt = select(EquipmentUnit).options(selectinload(EquipmentUnit.model))
+    stmt = stmt.where(*criteria)
+    if order_by is not None:
+        stmt = stmt.order_by(order_by)
+    stmt = stmt.order_by(EquipmentUnit.id).limit(limit)
+    return list((await db.execute(stmt)).scalars().all())
 
 
-def search_units(db: Session, query: str, limit: int = 10) -> list[EquipmentUnit]:
+async def search_units(db: AsyncSession, query: str, limit: int = 10) -> list[EquipmentUnit]:
     q = normalize_text(query)
     if not q:
         return []
 
-    stmt = select(EquipmentUnit).options(selectinload(EquipmentUnit.model))
-    units = list(db.execute(stmt).scalars().all())
-
-    exact_article = [
-        u for u in units
-        if normalize_text(u.article_number or "") == q
-    ]
-    if exact_article:
-        return exact_article[:1]
-
-    exact_internal = [
-        u for u in units
-        if normalize_text(u.internal_number or "") == q
-    ]
-    if exact_internal:
-        return exact_internal[:1]
-
-    article_contains = [
-        u for u in units
-        if q in normalize_text(u.article_number or "")
-    ]
-    if article_contains:
-        return article_contains[:limit]
-
-    internal_contains = [
-        u for u in units
-        if q in normalize_text(u.internal_number or "")
-    ]
-    if internal_contains:
-        return internal_contains[:limit]
-
-    model_matches = []
-    for unit in units:
-        model_name = unit.model.name if unit.model else ""
-        if q in normalize_text(model_name):
-            model_matches.append(unit)
-
-    return model_matches[:limit]
-
-
-def resolve_single_model(db: Session, query: str) -> EquipmentModel | None:
-    results = search_models(db, query=query, include_inactive=False, limit=5)
+    # Точное совпадение артикула приоритетнее внутреннего номера.
+    exact = await _find_units(
+        db,
+        or_(EquipmentUnit.article_search == q, EquipmentUnit.internal_search == q),
+        order_by=(EquipmentUnit.article_search == q).desc().nullslast(),
+        limit=1,
+    )
+    if exact:
+        return exact
+
+    by_prefix = await _find_units(
+        db,
+        or_(
+            EquipmentUnit.article_search.startswith(q),
+            EquipmentUnit.internal_search.startswith(q),
+        ),
+        order_by=EquipmentUnit.article_search.startswith(q).desc().nullslast(),
+        limit=limit,
+    )
+    if by_prefix:
+        return by_prefix
+
+    # По подстроке в названии модели: модели берём из индекса каталога
+    # (в памяти или GIN trgm), единицы — по индексу (model_id, status).
+    model_ids = await find_model_ids_containing(db, q)
+    if not model_ids:
+        return []
+    return await _find_units(db, EquipmentUnit.model_id.in_(model_ids), limit=limit)
+
+
+async def resolve_single_model(db: AsyncSession, query: str) -> EquipmentModel | None:
+    results = await search_models(db, query=query, include_inactive=False, limit=5)
     if len(results) == 1:
         return results[0]
     return None
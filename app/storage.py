@@ -0,0 +1,116 @@
+import time
+from typing import Any
+
+import orjson
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+from redis.asyncio import Redis
+
+
+# Данные держим столько же, сколько живёт состояние: TTL ключа data
+# подтягивается к TTL ключа state на той же стороне Redis, одним вызовом.
+_SET_DATA_SCRIPT = """
+redis.call('SET', KEYS[1], ARGV[1])
+local ttl = redis.call('PTTL', KEYS[2])
+if ttl > 0 then
+    redis.call('PEXPIRE', KEYS[1], ttl)
+elseif ARGV[2] ~= '' then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+"""
+
+PREFETCH_MAX_AGE = 5.0
+PREFETCH_MAX_KEYS = 1024
+
+
+# RedisStorage с orjson, TTL по группам состояний и чтением state+data
+# одним MGET: данные, прочитанные вместе с состоянием в начале апдейта,
+# отдаются следующему get_data того же ключа без второго запроса.
+class AppRedisStorage(RedisStorage):
+    def __init__(
+        self,
+        redis: Redis,
+        state_ttls: dict[type[StatesGroup], int] | None = None,
+        default_ttl: int | None = None,
+    ) -> None:
+        super().__init__(
+            redis=redis,
+            key_builder=DefaultKeyBuilder(with_bot_id=True),
+            state_ttl=default_ttl,
+            data_ttl=default_ttl,
+            json_loads=orjson.loads,
+            json_dumps=orjson.dumps,
+        )
+        self.state_ttls = {
+            group.__full_group_name__: ttl
+            for group, ttl in (state_ttls or {}).items()
+        }
+        self._prefetched: dict[str, tuple[float, bytes | None]] = {}
+        self._set_data = self.redis.register_script(_SET_DATA_SCRIPT)
+
+    def _ttl_for(self, state: str) -> int | None:
+        group, _, _ = state.rpartition(":")
+        return self.state_ttls.get(group, self.state_ttl)
+
+    def _remember(self, data_key: str, value: bytes | None) -> None:
+        if len(self._prefetched) >= PREFETCH_MAX_KEYS:
+            # Сбрасываем самые старые записи, которые никто не забрал.
+            for stale in list(self._prefetched)[: PREFETCH_MAX_KEYS // 2]:
+                del self._prefetched[stale]
+        self._prefetched[data_key] = (time.monotonic(), value)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state_key = self.key_builder.build(key, "state")
+        data_key = self.key_builder.build(key, "data")
+        self._prefetched.pop(data_key, None)
+
+        if state is None:
+            await self.redis.delete(state_key)
+            return
+
+        value = state.state if isinstance(state, State) else state
+        ttl = self._ttl_for(value)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(state_key, value, ex=ttl)
+            if ttl:
+                pipe.expire(data_key, ttl)
+            await pipe.execute()
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        state_key = self.key_builder.build(key, "state")
+        data_key = self.key_builder.build(key, "data")
+
+        state, data = await self.redis.mget(state_key, data_key)
+        self._remember(data_key, data)
+
+        if isinstance(state, bytes):
+            return state.decode("utf-8")
+        return state
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        state_key = self.key_builder.build(key, "state")
+        data_key = self.key_builder.build(key, "data")
+        self._prefetched.pop(data_key, None)
+
+        if not data:
+            await self.redis.delete(data_key)
+            return
+
+        await self._set_data(
+            keys=[data_key, state_key],
+            args=[self.json_dumps(data), self.data_ttl or ""],
+        )
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        data_key = self.key_builder.build(key, "data")
+
+        prefetched = self._prefetched.pop(data_key, None)
+        if prefetched is not None and time.monotonic() - prefetched[0] < PREFETCH_MAX_AGE:
+            value = prefetched[1]
+        else:
+            value = await self.redis.get(data_key)
+
+        if value is None:
+            return {}
+        return self.json_loads(value)
@@ -66,7 +66,9 @@ def format_status_label(status: str) -> str:
     return mapping.get(status, status)
 
 
-def format_order_card(order: Order) -> str:
+def format_order_card_parts(order: Order) -> tuple[str, str]:
+    # Карточка без строки статуса: её подставляет assemble_order_card,
+    # чтобы отрисованную часть можно было кэшировать между сменами статуса.
     client_name = (
         order.client.name
         if getattr(order, "client", None)
@@ -82,7 +84,10 @@ def format_order_card(order: Order) -> str:
         f"Даты: {dates_text}",
         f"Время: {times_text}",
         f"Смен: {order.shifts}",
-        f"Статус: {format_status_label(order.status)}",
+    ]
+    head = "\n".join(lines)
+
+    lines = [
         "",
         "Позиции:",
     ]
@@ -122,7 +127,16 @@ def format_order_card(order: Order) -> str:
         ]
     )
 
-    return "\n".join(lines)
+    return head, "\n".join(lines)
+
+
+def assemble_order_card(parts: tuple[str, str], status: str) -> str:
+    head, tail = parts
+    return f"{head}\nСтатус: {format_status_label(status)}\n{tail}"
+
+
+def format_order_card(order: Order) -> str:
+    return assemble_order_card(format_order_card_parts(order), order.status)
 
 
 def format_model_card(model: EquipmentModel) -> str:
@@ -201,6 +215,8 @@ def format_order_preview_with_items(
     client_total: float,
     subrental_total: float,
     comment: str,
+    shortages: list[tuple[str, int, int]] | None = None,
+    conflicting_orders: list[Order] | None = None,
 ) -> str:
     dates_text, times_text = format_booking_dates_and_times(start_at, end_at)
 
@@ -230,6 +246,19 @@ def format_order_preview_with_items(
         for name in not_found_items:
             lines.append(f"• {escape(name)}")
 
+    if shortages:
+        lines.extend(["", "Не хватает на эти даты:"])
+        for name, qty, free in shortages:
+            lines.append(f"• {escape(name)}: нужно {qty}, свободно {free}")
+
+    if conflicting_orders:
+        lines.extend(["", "Единицы заняты в сметах:"])
+        for order in conflicting_orders:
+            dates_text, _ = format_booking_dates_and_times(order.start_date, order.end_date)
+            lines.append(
+                f"• #{order.order_number:05d} {escape(order.project_name)} — {dates_text}"
+            )
+
     lines.extend(
         [
             "",
@@ -0,0 +1,24 @@
+import re
+
+
+def normalize_text(value: str) -> str:
+    text = value.lower().strip()
+    text = text.replace("ё", "е")
+    text = text.replace("–", "-").replace("—", "-")
+    text = text.replace("х", "x")
+    text = re.sub(r"[^a-zа-я0-9]+", " ", text, flags=re.IGNORECASE)
+    text = re.sub(r"\s+", " ", text).strip()
+    return text
+
+
+def normalize_aliases(aliases: list[str] | None) -> list[str]:
+    normalized = (normalize_text(alias) for alias in aliases or [])
+    return list(dict.fromkeys(alias for alias in normalized if alias))
+
+
+def split_article_number(article_number: str) -> tuple[str, int] | None:
+    prefix = article_number[:1]
+    digits = "".join(ch for ch in article_number if ch.isdigit())
+    if not prefix.isalpha() or not digits:
+        return None
+    return prefix, int(digits)
@@ -1,9 +1,14 @@
 import os
 from sqlalchemy import create_engine, text
 
+from app.db.pool import PoolSettings
+
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+engine = create_engine(
+    DATABASE_URL,
+    **PoolSettings.from_env().engine_kwargs(is_async=False),
+)
 
 def init_db():
     with engine.connect() as conn:
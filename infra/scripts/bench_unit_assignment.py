@@ -0,0 +1,67 @@
+"""Benchmark the unit allocator on a synthetic fleet.
+
+Usage: python infra/scripts/bench_unit_assignment.py [units] [bookings]
+"""
+import pathlib
+import random
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.parent))
+
+from app.services.unit_allocator import allocate_units  # noqa: E402
+
+MODELS = 200
+HORIZON_DAYS = 365
+SEED = 42
+
+
+def build_fleet(units: int) -> dict[int, dict[int, list[tuple[int, int]]]]:
+    rng = random.Random(SEED)
+    fleet: dict[int, dict[int, list[tuple[int, int]]]] = {}
+    for unit_id in range(1, units + 1):
+        fleet.setdefault(rng.randrange(MODELS), {})[unit_id] = []
+    return fleet
+
+
+def build_requests(bookings: int) -> list[tuple[int, int, int, int, int]]:
+    rng = random.Random(SEED + 1)
+    requests = []
+    for key in range(bookings):
+        start = rng.randrange(HORIZON_DAYS)
+        end = start + rng.choice((0, 0, 1, 2, 3, 6, 13))
+        requests.append((key, rng.randrange(MODELS), rng.choice((1, 1, 1, 2, 3)), start, end))
+    return requests
+
+
+def fragmentation(fleet: dict[int, dict[int, list[tuple[int, int]]]]) -> tuple[int, int]:
+    used = 0
+    gaps = 0
+    for units in fleet.values():
+        for intervals in units.values():
+            if intervals:
+                used += 1
+                gaps += len(intervals) - 1
+    return used, gaps
+
+
+def main() -> None:
+    units = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    bookings = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    fleet = build_fleet(units)
+    requests = build_requests(bookings)
+
+    started = time.perf_counter()
+    assigned, shortages = allocate_units(requests, fleet)
+    elapsed = time.perf_counter() - started
+
+    used, gaps = fragmentation(fleet)
+    placed = sum(len(unit_ids) for unit_ids in assigned.values())
+    print(f"units={units} bookings={bookings}")  # noqa: T201
+    print(f"placed={placed} short={len(shortages)} units_used={used} gaps={gaps}")  # noqa: T201
+    print(f"total={elapsed * 1000:.1f} ms per_booking={elapsed / bookings * 1e6:.1f} us")  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,37 @@
 import asyncio
+import hashlib
+import json
 import logging
 
 from aiogram import Bot, Dispatcher, Router
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.filters import BaseFilter
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import BotCommand, Message
-from sqlalchemy import text
-
-from app.config import ALLOWED_USERS, BOT_TOKEN
-from app.db.base import Base, SessionLocal, engine
-from app.db import models  # noqa: F401
+from redis.asyncio import Redis
+
+from app.config import (
+    ALLOWED_USERS,
+    BOT_TOKEN,
+    CATALOG_SEARCH_BACKEND,
+    FSM_TTL_SECONDS,
+    REDIS_URL,
+)
+from app.db.base import SessionLocal, engine
+from app.db.migrations import run_migrations
+from app.db.pool import log_pool_metrics
 from app.handlers.common import router as common_router
 from app.handlers.orders import router as orders_router
 from app.handlers.catalog import router as catalog_router
 from app.handlers.units import router as units_router
-from app.services.inventory_service import sync_search_names
+from app.services.catalog_index import catalog_index
+from app.services.occupancy_cache import occupancy_cache
+from app.services.order_card_cache import order_card_cache
+from app.services.settings_service import get_setting, set_setting
+from app.states import EditSavedOrderFlow, NewOrderFlow
+from app.storage import AppRedisStorage
 
 
 logging.basicConfig(level=logging.INFO)
@@ -30,79 +46,76 @@ class AllowedUserFilter(BaseFilter):
         return message.from_user.id in ALLOWED_USERS
 
 
+BOT_COMMANDS = [
+    BotCommand(command="start", description="Запуск"),
+    BotCommand(command="new", description="Новая смета"),
+    BotCommand(command="order", description="Открыть смету"),
+    BotCommand(command="last", description="Последняя смета"),
+    BotCommand(command="addmodel", description="Добавить модель"),
+    BotCommand(command="findmodel", description="Найти модель"),
+    BotCommand(command="editmodel", description="Изменить модель"),
+    BotCommand(command="addunit", description="Добавить артикул"),
+    BotCommand(command="findunit", description="Найти артикул"),
+    BotCommand(command="cancel", description="Сброс"),
+]
+
+
+def _commands_digest(commands: list[BotCommand]) -> str:
+    payload = json.dumps(
+        [command.model_dump() for command in commands],
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
 async def set_main_menu(bot: Bot) -> None:
-    commands = [
-        BotCommand(command="start", description="Запуск"),
-        BotCommand(command="new", description="Новая смета"),
-        BotCommand(command="order", description="Открыть смету"),
-        BotCommand(command="last", description="Последняя смета"),
-        BotCommand(command="addmodel", description="Добавить модель"),
-        BotCommand(command="findmodel", description="Найти модель"),
-        BotCommand(command="editmodel", description="Изменить модель"),
-        BotCommand(command="addunit", description="Добавить артикул"),
-        BotCommand(command="findunit", description="Найти артикул"),
-        BotCommand(command="cancel", description="Сброс"),
-    ]
-    await bot.set_my_commands(commands)
-
-
-def create_tables() -> None:
-    Base.metadata.create_all(bind=engine)
-
-
-def ensure_schema_updates() -> None:
-    with engine.begin() as conn:
-        conn.execute(text(
-            "ALTER TABLE equipment_models ADD COLUMN IF NOT EXISTS search_name TEXT"
-        ))
-        conn.execute(text(
-            "ALTER TABLE equipment_models ADD COLUMN IF NOT EXISTS is_active BOOLEAN NOT NULL DEFAULT TRUE"
-        ))
-        conn.execute(text(
-            "UPDATE equipment_models SET search_name = '' WHERE search_name IS NULL"
-        ))
-
-        conn.execute(text(
-            "ALTER TABLE orders ADD COLUMN IF NOT EXISTS start_at TIMESTAMP NULL"
-        ))
-        conn.execute(text(
-            "ALTER TABLE orders ADD COLUMN IF NOT EXISTS end_at TIMESTAMP NULL"
-        ))
-        conn.execute(text(
-            "ALTER TABLE orders ADD COLUMN IF NOT EXISTS subtotal NUMERIC(12,2) NOT NULL DEFAULT 0"
-        ))
-        conn.execute(text(
-            "ALTER TABLE orders ADD COLUMN IF NOT EXISTS discount_percent NUMERIC(5,2) NOT NULL DEFAULT 0"
-        ))
-
-        conn.execute(text(
-            "ALTER TABLE equipment_units ADD COLUMN IF NOT EXISTS defects TEXT"
-        ))
-        conn.execute(text(
-            "ALTER TABLE equipment_units ADD COLUMN IF NOT EXISTS article_number TEXT"
-        ))
-
-        conn.execute(text(
-            "CREATE UNIQUE INDEX IF NOT EXISTS uq_equipment_units_article_number_idx "
-            "ON equipment_units (article_number)"
-        ))
-
-
-def bootstrap_catalog_metadata() -> None:
-    with SessionLocal() as db:
-        sync_search_names(db)
+    # Bot API дёргаем, только если список команд изменился с прошлого запуска.
+    key = f"bot_commands_digest:{bot.id}"
+    digest = _commands_digest(BOT_COMMANDS)
+
+    async with SessionLocal() as db:
+        if await get_setting(db, key) == digest:
+            return
+        await bot.set_my_commands(BOT_COMMANDS)
+        await set_setting(db, key, digest)
+
+
+def build_fsm_storage(redis: Redis | None) -> BaseStorage:
+    if redis is None:
+        return MemoryStorage()
+
+    # Черновик сметы живёт дольше короткой правки: его собирают днями.
+    return AppRedisStorage(
+        redis=redis,
+        state_ttls={
+            NewOrderFlow: 7 * FSM_TTL_SECONDS,
+            EditSavedOrderFlow: FSM_TTL_SECONDS,
+        },
+        default_ttl=FSM_TTL_SECONDS,
+    )
+
+
+async def bootstrap_catalog_metadata() -> None:
+    async with SessionLocal() as db:
+        if CATALOG_SEARCH_BACKEND == "memory":
+            await catalog_index.rebuild(db)
+        await occupancy_cache.rebuild(db)
 
 
 async def main() -> None:
-    create_tables()
-    ensure_schema_updates()
-    bootstrap_catalog_metadata()
+    applied = await run_migrations(engine)
+    if applied:
+        logging.info("Applied migrations: %s", ", ".join(applied))
+    await bootstrap_catalog_metadata()
 
     bot = Bot(
         token=BOT_TOKEN,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML),
     )
-    dp = Dispatcher()
+    redis = Redis.from_url(REDIS_URL) if REDIS_URL else None
+    order_card_cache.configure(redis)
+    dp = Dispatcher(storage=build_fsm_storage(redis))
 
     protected_router = Router()
     protected_router.message.filter(AllowedUserFilter())
@@ -114,7 +127,13 @@ async def main() -> None:
     dp.include_router(protected_router)
 
     await set_main_menu(bot)
-    await dp.start_polling(bot)
+    pool_metrics_task = asyncio.create_task(log_pool_metrics(engine))
+    try:
+        await dp.start_polling(bot)
+    finally:
+        pool_metrics_task.cancel()
+        await dp.storage.close()
+        await engine.dispose()
 
 
 if __name__ == "__main__":